@@ -1,61 +1,681 @@
 import os
+
+# SERVER_MODE=production runs on a cooperative (green thread) server. The
+# standard library must be patched before anything else imports it, and
+# psycopg2 must be told to yield to the event loop while waiting on Postgres.
+SERVER_MODE = os.environ.get('SERVER_MODE', 'development')
+ASYNC_MODE = os.environ.get(
+    'ASYNC_MODE', 'eventlet' if SERVER_MODE == 'production' else 'threading'
+)
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    import eventlet.tpool
+    eventlet.monkey_patch()
+    from psycogreen.eventlet import patch_psycopg
+    patch_psycopg()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
 import logging
 import traceback
 import json
 import random
-from datetime import datetime
+import threading
+import time
+import bisect
+import queue
+import atexit
+import gzip
+import hashlib
+import mimetypes
+import io
+import re
+import sys
+import argparse
+import subprocess
+import functools
+import struct
+from array import array
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing.connection import Client, Listener
+from datetime import datetime, timedelta
 from flask import (
     Flask, render_template, request, jsonify,
-    session, send_from_directory
+    session, send_from_directory, send_file, g
 )
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from socketio import PubSubManager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event as sa_event, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached
 from flask_login import (
     LoginManager, UserMixin, login_user,
     login_required, logout_user, current_user
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from PIL import Image, ImageOps, features
+from sortedcontainers import SortedList
+
+import migrate
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are built
+    brotli = None
 
 # ─── BASIC SETUP ────────────────────────────────────────────────────────────────
 
-# Create logs & uploads directories if not exist
-os.makedirs('logs', exist_ok=True)
+# Create uploads directory if not exists (logs/ is created by start_logging)
 os.makedirs('uploads', exist_ok=True)
 
-# Main application logger
-logger = logging.getLogger('app')
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler('logs/app.log')
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(levelname)s - %(message)s'
-))
-logger.addHandler(file_handler)
+def parse_sample_rates(spec):
+    """Parse ``"/rule=0.1,/other=0.5"`` into {rule: rate}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        rule, _, rate = item.rpartition('=')
+        rates[rule] = float(rate)
+    return rates
+
+
+def parse_rate_limits(spec):
+    """Parse ``"move=20:10,attack=8:4"`` into {event: (rate/s, burst)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, limit = item.partition('=')
+        rate, _, burst = limit.partition(':')
+        limits[event] = (float(rate), float(burst or rate))
+    return limits
 
-# Raw HTTP request/response logger
-raw_logger = logging.getLogger('raw')
-raw_logger.setLevel(logging.INFO)
-raw_handler = logging.FileHandler('logs/http.log')
-raw_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(message)s'
-))
-raw_logger.addHandler(raw_handler)
 
-app = Flask(__name__)
+# /static is served by static_file() below so it can use the asset manifest
+app = Flask(__name__, static_folder=None)
+DEFAULT_SECRET_KEY = 'your-secret-key-here'
 app.config.update({
-    'SECRET_KEY': os.environ.get('SECRET_KEY', 'your-secret-key-here'),
+    'SECRET_KEY': os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY),
     'SQLALCHEMY_DATABASE_URI': os.environ.get(
         'DATABASE_URL',
         'postgresql://postgres:postgres@db:5432/gridgame'
     ),
     'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    # connection pool sized for the number of handlers that may hit the DB
+    # at once; pre-ping drops connections Postgres closed while idle
+    'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'DB_POOL_TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    # startup leaves bulk migrations (backfills, index builds) to
+    # `python migrate.py upgrade` once the user table is bigger than this
+    'MIGRATE_MAX_ROWS': int(os.environ.get('MIGRATE_MAX_ROWS', 50000)),
     'UPLOAD_FOLDER': 'uploads',
     'MAX_CONTENT_LENGTH': 16 * 1024 * 1024,  # 16MB
     'SESSION_COOKIE_HTTPONLY': True,          # HttpOnly cookie
+    # seconds between write-behind flushes of in-memory player state
+    'STATE_FLUSH_INTERVAL': float(os.environ.get('STATE_FLUSH_INTERVAL', 2.0)),
+    # lobby simulation/broadcast rate (Hz) and full-state keyframe period (ticks)
+    'TICK_RATE': float(os.environ.get('TICK_RATE', 20)),
+    'KEYFRAME_INTERVAL': int(os.environ.get('KEYFRAME_INTERVAL', 40)),
+    # arena size in cells (the client canvas is sized to match)
+    'GRID_WIDTH': int(os.environ.get('GRID_WIDTH', 20)),
+    'GRID_HEIGHT': int(os.environ.get('GRID_HEIGHT', 15)),
+    # area of interest: players only receive updates about others within
+    # this many cells (0 = whole lobby), and the cap on lobby size
+    'VIEW_RADIUS': int(os.environ.get('VIEW_RADIUS', 0)),
+    'MAX_LOBBY_PLAYERS': int(os.environ.get('MAX_LOBBY_PLAYERS', 200)),
+    # seconds a cached User row serves Flask-Login without a query; rows of
+    # users with an open socket stay cached until invalidated
+    'USER_CACHE_TTL': float(os.environ.get('USER_CACHE_TTL', 30)),
+    # password hashing: werkzeug method string (sets the cost), worker
+    # processes (0 = hash in-process), and how many hashes may be waiting
+    # or running before /register and /login answer 503
+    'PASSWORD_HASH_METHOD': os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+    'PASSWORD_WORKERS': int(os.environ.get('PASSWORD_WORKERS', 2)),
+    'PASSWORD_QUEUE_LIMIT': int(os.environ.get('PASSWORD_QUEUE_LIMIT', 16)),
+    # register/login attempts allowed per client IP and per username (rate/s:burst)
+    'AUTH_RATE_LIMITS': parse_rate_limits(os.environ.get(
+        'AUTH_RATE_LIMITS', 'ip=1:20,username=0.1:5'
+    )),
+    # lobby lifecycle: seconds an empty lobby's state stays in memory, an
+    # empty Lobby row is kept (0 = forever) and a player without a socket
+    # keeps their place, plus how often the reaper runs. Socket.IO's own
+    # ping/pong is the heartbeat that detects a lost socket.
+    'LOBBY_IDLE_TTL': float(os.environ.get('LOBBY_IDLE_TTL', 300)),
+    'LOBBY_ROW_TTL': float(os.environ.get('LOBBY_ROW_TTL', 3600)),
+    'PLAYER_HEARTBEAT_TIMEOUT': float(os.environ.get('PLAYER_HEARTBEAT_TIMEOUT', 30)),
+    'LOBBY_REAP_INTERVAL': float(os.environ.get('LOBBY_REAP_INTERVAL', 10)),
+    'SOCKETIO_PING_INTERVAL': float(os.environ.get('SOCKETIO_PING_INTERVAL', 10)),
+    'SOCKETIO_PING_TIMEOUT': float(os.environ.get('SOCKETIO_PING_TIMEOUT', 10)),
+    # matchmaking: seconds between placement batches, size of the lobbies it
+    # creates, skill points per bracket (skill = lifetime_score + wins *
+    # MATCHMAKING_WIN_WEIGHT), seconds of waiting that widen the match by
+    # one bracket, and seconds a placed player's seat is held for their join
+    'MATCHMAKING_INTERVAL': float(os.environ.get('MATCHMAKING_INTERVAL', 0.3)),
+    'MATCHMAKING_LOBBY_SIZE': int(os.environ.get('MATCHMAKING_LOBBY_SIZE', 4)),
+    'MATCHMAKING_SKILL_BAND': int(os.environ.get('MATCHMAKING_SKILL_BAND', 1000)),
+    'MATCHMAKING_WIN_WEIGHT': int(os.environ.get('MATCHMAKING_WIN_WEIGHT', 500)),
+    'MATCHMAKING_WIDEN_AFTER': float(os.environ.get('MATCHMAKING_WIDEN_AFTER', 5)),
+    'MATCHMAKING_SEAT_TTL': float(os.environ.get('MATCHMAKING_SEAT_TTL', 10)),
+    # match replays: directory for the per-match logs ('' = off), ticks
+    # between full snapshots, and seconds between writes to disk
+    'REPLAY_DIR': os.environ.get('REPLAY_DIR', ''),
+    'REPLAY_SNAPSHOT_INTERVAL': int(os.environ.get('REPLAY_SNAPSHOT_INTERVAL', 200)),
+    'REPLAY_FLUSH_INTERVAL': float(os.environ.get('REPLAY_FLUSH_INTERVAL', 1.0)),
+    # replay retention, enforced by the lobby reaper: most files kept, and
+    # seconds a finished log is kept (0 = no limit)
+    'REPLAY_MAX_FILES': int(os.environ.get('REPLAY_MAX_FILES', 1000)),
+    'REPLAY_MAX_AGE': float(os.environ.get('REPLAY_MAX_AGE', 7 * 24 * 3600)),
+    # allow /debug/profile to record stack samples on demand
+    'PROFILER_ENABLED': os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes'),
+    # combat: damage per hit, projectile speed (cells/s) and reach (cells)
+    'MELEE_DAMAGE': int(os.environ.get('MELEE_DAMAGE', 20)),
+    'RANGED_DAMAGE': int(os.environ.get('RANGED_DAMAGE', 10)),
+    'PROJECTILE_SPEED': float(os.environ.get('PROJECTILE_SPEED', 12)),
+    'PROJECTILE_RANGE': int(os.environ.get('PROJECTILE_RANGE', 8)),
+    # per-socket token buckets for client events (rate/s:burst), and the
+    # minimum seconds between two attacks of the same kind by one player
+    'INPUT_RATE_LIMITS': parse_rate_limits(os.environ.get(
+        'INPUT_RATE_LIMITS', 'move=20:10,attack=8:4,request_keyframe=1:3,find_match=1:3'
+    )),
+    'ATTACK_COOLDOWNS': {
+        'melee': float(os.environ.get('MELEE_COOLDOWN', 0.4)),
+        'ranged': float(os.environ.get('RANGED_COOLDOWN', 0.4)),
+    },
+    # log pipeline: queue bound, per-file rotation, and the fraction of
+    # requests per URL rule whose raw headers/bodies go to http.log
+    'LOG_QUEUE_SIZE': int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+    'LOG_MAX_BYTES': int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+    'LOG_BACKUP_COUNT': int(os.environ.get('LOG_BACKUP_COUNT', 5)),
+    'LOG_SAMPLE_RATES': parse_sample_rates(os.environ.get(
+        'LOG_SAMPLE_RATES',
+        '/uploads/<filename>=0.05,/static/<path:filename>=0.05'
+    )),
+    # square avatar renditions (px); "cell" matches one grid cell on the canvas
+    'AVATAR_SIZES': {'cell': 40, 'small': 64, 'large': 256},
+    'AVATAR_WORKERS': int(os.environ.get('AVATAR_WORKERS', 2)),
+    'PORT': int(os.environ.get('PORT', 8080)),
+    # multi-worker mode: Socket.IO message queue (redis://, amqp://, or
+    # local://host:port for the bundled broker), this worker's index and
+    # the public base URL of every worker, in index order
+    'SOCKETIO_MESSAGE_QUEUE': os.environ.get('SOCKETIO_MESSAGE_QUEUE'),
+    'WORKER_ID': int(os.environ.get('WORKER_ID', 0)),
+    'WORKER_URLS': [u for u in os.environ.get('WORKER_URLS', '').split(',') if u],
+    # seconds before shared in-memory caches (leaderboard, lobby list) are
+    # reloaded from the DB when other workers may have changed them
+    'SHARED_CACHE_TTL': float(os.environ.get('SHARED_CACHE_TTL', 10)),
 })
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def run_blocking(fn, *args):
+    """Run CPU-bound ``fn`` on a real OS thread when serving on green threads.
+
+    Under eventlet/gevent a long computation would otherwise stall every
+    socket on the worker; in threading mode it is simply called.
+    """
+    if ASYNC_MODE == 'eventlet':
+        return eventlet.tpool.execute(fn, *args)
+    if ASYNC_MODE == 'gevent':
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+# ─── LOGGING PIPELINE ──────────────────────────────────────────────────────────
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks: records that don't fit are counted and dropped."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; structured data comes from ``extra={'fields': ...}``."""
+
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, default=str)
+
+
+def make_rotating_handler(path, formatter, logger_name):
+    handler = RotatingFileHandler(
+        path,
+        maxBytes=app.config['LOG_MAX_BYTES'],
+        backupCount=app.config['LOG_BACKUP_COUNT']
+    )
+    handler.setFormatter(formatter)
+    handler.addFilter(logging.Filter(logger_name))
+    return handler
+
+
+# Request threads only enqueue records; a single listener thread formats
+# them and does all file I/O. The files are opened and the listener
+# started by start_logging() at startup, so importing this module (as
+# bench.py does) opens nothing; records logged before then wait in the
+# queue.
+log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+queue_handler = DroppingQueueHandler(log_queue)
+log_listener = None
+
+
+def start_logging():
+    global log_listener
+    os.makedirs('logs', exist_ok=True)
+    log_listener = QueueListener(
+        log_queue,
+        # Main application logger
+        make_rotating_handler('logs/app.log', logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s'
+        ), 'app'),
+        # Raw HTTP request/response logger
+        make_rotating_handler('logs/http.log', JsonFormatter(), 'raw'),
+        respect_handler_level=True
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+logger = logging.getLogger('app')
+logger.setLevel(logging.INFO)
+logger.addHandler(queue_handler)
 
-socketio = SocketIO(app, cors_allowed_origins="*")
-db = SQLAlchemy(app)
+raw_logger = logging.getLogger('raw')
+raw_logger.setLevel(logging.INFO)
+raw_logger.addHandler(queue_handler)
+
+
+class LatencyHistogram:
+    """Cumulative-bucket latency histogram (Prometheus style), in seconds."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def to_dict(self):
+        cumulative, buckets = 0, {}
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += n
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        return {'count': self.count, 'sum': round(self.sum, 6), 'buckets': buckets}
+
+
+# URL rule -> LatencyHistogram, fed by log_response
+http_latency = {}
+http_latency_lock = threading.Lock()
+
+# ─── METRICS ───────────────────────────────────────────────────────────────────
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Series are keyed by metric name and a sorted label tuple. Values that
+    already live elsewhere (gauges, the HTTP latency histograms) are read
+    at scrape time by functions registered with ``collector``.
+    """
+
+    def __init__(self):
+        self.families = {}  # name -> (type, help)
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        self.families[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram(buckets)
+            histogram.observe(value)
+
+    def collector(self, fn):
+        """Register ``fn() -> [(name, type, help, [(labels, value), ...])]``."""
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, **extra):
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (
+            (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in pairs
+        )
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append((labels, value))
+            for (name, labels), histogram in self.histograms.items():
+                samples.setdefault(name, []).append((labels, histogram.to_dict()))
+        families = dict(self.families)
+        for collect in self.collectors:
+            for name, kind, help_text, series in collect():
+                families[name] = (kind, help_text)
+                samples.setdefault(name, []).extend(
+                    (tuple(sorted(labels.items())), value) for labels, value in series
+                )
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = families.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples[name]:
+                if kind == 'histogram':
+                    for bound, n in value['buckets'].items():
+                        lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {n}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value['sum']}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value['count']}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.describe('socketio_events_total', 'counter', 'Socket.IO events handled, by event')
+metrics.describe('socketio_event_duration_seconds', 'histogram', 'Socket.IO handler time, by event')
+metrics.describe('socketio_broadcast_recipients', 'histogram', 'Sockets reached per room broadcast, by event')
+metrics.describe('http_requests_total', 'counter', 'HTTP responses, by route, method and status')
+metrics.describe('db_queries_total', 'counter', 'SQL statements executed, by handler')
+metrics.describe('db_query_seconds_total', 'counter', 'Time spent in SQL statements, by handler')
+
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# the route or socket event the current thread/greenlet is serving; SQL
+# statements are attributed to it ("background" for the tick and flush)
+metrics_context = threading.local()
+
+
+def current_handler():
+    return getattr(metrics_context, 'handler', None) or 'background'
+
+
+def instrumented(event):
+    """Count and time a Socket.IO handler, and attribute its SQL to it."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            previous = getattr(metrics_context, 'handler', None)
+            metrics_context.handler = f'socket:{event}'
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                metrics.observe('socketio_event_duration_seconds',
+                                time.perf_counter() - started, event=event)
+                metrics.inc('socketio_events_total', event=event)
+                metrics_context.handler = previous
+        return wrapper
+    return decorator
+
+
+@sa_event.listens_for(Engine, 'before_cursor_execute')
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@sa_event.listens_for(Engine, 'after_cursor_execute')
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['metrics_started'].pop()
+    handler = current_handler()
+    metrics.inc('db_queries_total', handler=handler)
+    metrics.inc('db_query_seconds_total', time.perf_counter() - started, handler=handler)
+
+
+@sa_event.listens_for(Engine, 'handle_error')
+def _sql_failed(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('metrics_started'):
+        conn.info['metrics_started'].pop()
+
+
+def _original(module, name):
+    """``module.name`` as it was before eventlet/gevent monkey patching."""
+    if ASYNC_MODE == 'eventlet':
+        return getattr(eventlet.patcher.original(module), name)
+    if ASYNC_MODE == 'gevent':
+        return monkey.get_original(module, name)
+    return getattr(sys.modules[module], name)
+
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval for a time window.
+
+    The result is in the collapsed-stack format (``frame;frame;frame N``)
+    read by flamegraph.pl and speedscope. The sampler is a real OS thread,
+    so under eventlet/gevent it sees whichever greenlet is running.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = False
+
+    def profile(self, seconds, interval):
+        with self.lock:
+            if self.running:
+                raise RuntimeError('a profile is already being recorded')
+            self.running = True
+        stacks = Counter()
+
+        def sample():
+            sleep = _original('time', 'sleep')
+            me = _original('threading', 'get_ident')()
+            deadline = time.monotonic() + seconds
+            try:
+                while time.monotonic() < deadline:
+                    for thread_id, frame in sys._current_frames().items():
+                        if thread_id == me:
+                            continue
+                        stack = []
+                        while frame is not None:
+                            code = frame.f_code
+                            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                            frame = frame.f_back
+                        stacks[';'.join(reversed(stack))] += 1
+                    sleep(interval)
+            finally:
+                self.running = False
+
+        _original('threading', 'Thread')(target=sample, daemon=True).start()
+        # poll rather than wait on an Event: the sampler is not a greenlet
+        while self.running:
+            socketio.sleep(0.1)
+        return ''.join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+# ─── MULTI-WORKER SUPPORT ──────────────────────────────────────────────────────
+
+class HashRing:
+    """Consistent hash ring assigning each lobby to exactly one worker."""
+
+    def __init__(self, workers, replicas=160):
+        self._ring = sorted(
+            (self._hash(f"{worker}:{i}"), worker)
+            for worker in workers for i in range(replicas)
+        )
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def owner(self, key):
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[i][1]
+
+
+def parse_local_queue(url):
+    host, _, port = url[len('local://'):].partition(':')
+    return (host or '127.0.0.1', int(port or 5055))
+
+
+def local_broker_authkey():
+    """Key the ``local://`` broker connections authenticate with.
+
+    Anyone holding it can publish to every worker, so the well-known
+    default secret is refused.
+    """
+    if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY:
+        raise RuntimeError('set SECRET_KEY before using the local:// message queue')
+    return app.config['SECRET_KEY'].encode()
+
+
+class LocalBrokerManager(PubSubManager):
+    """Socket.IO client manager for the bundled ``local://`` broker.
+
+    A stand-in for Redis when running several workers on one machine:
+    messages published by any worker are fanned out to every worker by
+    ``run_local_broker``. Messages travel as JSON, never pickles.
+    """
+
+    name = 'local'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        self.address = parse_local_queue(url)
+        self.authkey = local_broker_authkey()
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        with self._publish_lock:
+            try:
+                if self._publisher is None:
+                    self._publisher = Client(self.address, authkey=self.authkey)
+                    self._publisher.send_bytes(b'publish')
+                self._publisher.send_bytes(json.dumps(data).encode())
+            except (OSError, EOFError):
+                self._publisher = None
+                raise
+
+    def _listen(self):
+        while True:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+                conn.send_bytes(b'subscribe')
+                while True:
+                    yield json.loads(conn.recv_bytes())
+            except (OSError, EOFError):
+                logger.warning(f"local broker at {self.address} unavailable, retrying")
+                time.sleep(1)
+
+
+def run_local_broker(address, authkey):
+    """Fan out every message from any publisher to every subscriber.
+
+    Messages are relayed as raw bytes; nothing here unpickles them.
+    """
+    listener = Listener(address, authkey=authkey)
+    subscribers = []
+    lock = threading.Lock()
+
+    def serve(conn):
+        try:
+            role = conn.recv_bytes()
+        except (OSError, EOFError):
+            return
+        if role == b'subscribe':
+            with lock:
+                subscribers.append(conn)
+            return
+        while True:
+            try:
+                message = conn.recv_bytes()
+            except (OSError, EOFError):
+                return
+            with lock:
+                for sub in list(subscribers):
+                    try:
+                        sub.send_bytes(message)
+                    except (OSError, EOFError):
+                        subscribers.remove(sub)
+
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+MULTI_WORKER = len(app.config['WORKER_URLS']) > 1
+lobby_ring = HashRing(range(len(app.config['WORKER_URLS']))) if MULTI_WORKER else None
+
+
+def lobby_owner(lobby_id):
+    """Index of the worker that holds the state for ``lobby_id``."""
+    return lobby_ring.owner(lobby_id) if MULTI_WORKER else app.config['WORKER_ID']
+
+
+def owns_lobby(lobby_id):
+    return lobby_owner(lobby_id) == app.config['WORKER_ID']
+
+
+def shared_cache_stale(loaded_at):
+    """With several workers, caches of shared data must expire."""
+    return MULTI_WORKER and time.monotonic() - loaded_at > app.config['SHARED_CACHE_TTL']
+
+
+def socketio_options():
+    url = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalBrokerManager(url)}
+    return {'message_queue': url}
+
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE,
+                    ping_interval=app.config['SOCKETIO_PING_INTERVAL'],
+                    ping_timeout=app.config['SOCKETIO_PING_TIMEOUT'],
+                    **socketio_options())
+# bound by init_db, so the engine (and the DB driver import) waits for startup
+db = SQLAlchemy()
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -64,12 +684,22 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 # ─── HTTP REQUEST/RESPONSE LOGGING ─────────────────────────────────────────────
 
+def request_rule():
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
 # ─── REQUEST/RESPONSE LOGGING ────────────────────────────────────────────────
 @app.before_request
 def log_request():
-    request.start_time = datetime.utcnow()
+    request.start_time = time.perf_counter()
+    metrics_context.handler = f"http:{request_rule()}"
+    rate = app.config['LOG_SAMPLE_RATES'].get(request_rule(), 1.0)
+    request.log_sampled = rate >= 1.0 or random.random() < rate
+    if not request.log_sampled:
+        return
+
     ip   = request.remote_addr
-    user = current_user.username if current_user.is_authenticated else None
+    user = request_user()
 
     # prepare headers without auth tokens
     headers = dict(request.headers)
@@ -81,24 +711,35 @@ def log_request():
                  if not c.startswith('session=') and not c.startswith('authtoken=')]
         headers['Cookie'] = '; '.join(parts)
 
-    raw_logger.info(f"REQ {request.method} {request.path} from={ip} user={user} headers={headers}")
+    fields = {'dir': 'req', 'method': request.method, 'path': request.path,
+              'ip': ip, 'user': user, 'headers': headers}
 
     # Only log bodies for non-login/register and text content
     if request.data and request.mimetype.startswith('text') \
        and request.path not in ['/login', '/register']:
-        body = request.get_data(as_text=True)[:2048]
-        raw_logger.info(f"REQ BODY: {body}")
+        fields['body'] = request.get_data(as_text=True)[:2048]
+
+    raw_logger.info('REQ', extra={'fields': fields})
 
 
 @app.after_request
 def log_response(response):
     ip   = request.remote_addr
-    user = current_user.username if current_user.is_authenticated else None
-    duration = (datetime.utcnow() - request.start_time).total_seconds()
+    user = request_user()
+    duration = time.perf_counter() - request.start_time
+
+    rule = request_rule()
+    with http_latency_lock:
+        http_latency.setdefault(rule, LatencyHistogram()).observe(duration)
+    metrics.inc('http_requests_total', route=rule, method=request.method,
+                status=response.status_code)
 
     # Main app.log: include response.status (e.g. "200 OK")
     logger.info(f"{ip} user={user} {request.method} {request.path} -> {response.status} ({duration:.3f}s)")
 
+    if not request.log_sampled:
+        return response
+
     # Raw response log
     headers = dict(response.headers)
     headers.pop('Authorization', None)
@@ -107,11 +748,14 @@ def log_response(response):
         cookies = headers['Set-Cookie'].split('; ')
         cookies = [c for c in cookies if not c.startswith('session=') and not c.startswith('authtoken=')]
         headers['Set-Cookie'] = '; '.join(cookies)
-    raw_logger.info(f"RES {response.status} headers={headers}")
+    fields = {'dir': 'res', 'method': request.method, 'path': request.path,
+              'status': response.status_code, 'duration': round(duration, 6),
+              'headers': headers}
 
     if not response.direct_passthrough and response.mimetype.startswith('text'):
-        data = response.get_data(as_text=True)[:2048]
-        raw_logger.info(f"RES BODY: {data}")
+        fields['body'] = response.get_data(as_text=True)[:2048]
+
+    raw_logger.info('RES', extra={'fields': fields})
 
     return response
 
@@ -120,11 +764,75 @@ def log_response(response):
 def handle_exception(e):
     tb = traceback.format_exc()
     ip   = request.remote_addr
-    user = current_user.username if current_user.is_authenticated else None
+    user = request_user()
     logger.error(f"Exception on {request.method} {request.path} from={ip} user={user}\n{tb}")
     return jsonify({'error': 'Internal server error'}), 500
 
 
+@app.teardown_request
+def clear_metrics_handler(exc=None):
+    metrics_context.handler = None
+
+
+# ─── PASSWORD HASHING ──────────────────────────────────────────────────────────
+
+class PasswordHasherBusy(Exception):
+    """Too many hashes already queued; the caller should answer 503."""
+
+
+class PasswordHasher:
+    """Password hashing on a bounded pool of worker processes.
+
+    Hashing is slow on purpose. Running it in other processes keeps a burst
+    of logins from stalling the game events this worker serves, and a
+    queue beyond ``limit`` fails fast instead of piling up.
+
+    Under eventlet/gevent a process pool can't be used: its management
+    threads wait on monkey-patched locks and never wake. There hashing
+    goes to the hub's native threadpool instead (scrypt and pbkdf2 drop
+    the GIL while they run), still bounded by ``limit``.
+    """
+
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.limit = limit
+        self.pool = None  # started on first use, after startup
+        self.pending = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        with self.lock:
+            if self.pending >= self.limit:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+            if self.pool is None and self.workers and ASYNC_MODE == 'threading':
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            if self.pool is None:
+                return run_blocking(fn, *args)
+            return self.pool.submit(fn, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'limit': self.limit,
+                    'pending': self.pending, 'rejected': self.rejected}
+
+
+password_hasher = PasswordHasher(app.config['PASSWORD_WORKERS'],
+                                 app.config['PASSWORD_QUEUE_LIMIT'])
+
+
 # ─── DATABASE MODELS ───────────────────────────────────────────────────────────
 
 class User(UserMixin, db.Model):
@@ -132,21 +840,26 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(512), nullable=False)
     avatar = db.Column(db.String(200))
-    position = db.Column(db.String(50), default='{"x": 0, "y": 0}')
+    # grid cell; replaced the JSON ``position`` column (see migrate.py)
+    pos_x = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    pos_y = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     health = db.Column(db.Integer, default=100)
     score = db.Column(db.Integer, default=0)
-    lifetime_score = db.Column(db.Integer, default=0)
+    lifetime_score = db.Column(db.Integer, default=0, index=True)
     kills = db.Column(db.Integer, default=0)
     deaths = db.Column(db.Integer, default=0)
     wins = db.Column(db.Integer, default=0)
-    current_lobby = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=True)
+    current_lobby = db.Column(db.Integer, db.ForeignKey('lobby.id'), nullable=True, index=True)
+    # set by every write; other workers' leaderboards refresh from it
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           index=True)
     achievements = db.relationship('UserAchievement', backref='user', lazy=True)
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = password_hasher.hash(pw)
 
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+        return password_hasher.verify(self.password_hash, pw)
 
     def to_dict(self):
         return {
@@ -177,6 +890,7 @@ class Achievement(db.Model):
 
 
 class UserAchievement(db.Model):
+    __table_args__ = (db.Index('uq_user_achievement', 'user_id', 'achievement_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     achievement_id = db.Column(db.Integer, db.ForeignKey('achievement.id'), nullable=False)
@@ -184,20 +898,617 @@ class UserAchievement(db.Model):
     achievement = db.relationship('Achievement', backref='user_achievements', lazy=True)
 
 
+# ─── USER IDENTITY CACHE ───────────────────────────────────────────────────────
+
+class UserCache:
+    """Per-process cache of User rows behind Flask-Login's user_loader.
+
+    Entries hold column values rather than ORM instances, so every request
+    or socket event gets its own instance in its own session without a
+    SELECT. An entry expires after ``USER_CACHE_TTL`` seconds unless a
+    socket connection has it pinned. Code that writes a user's row must
+    call ``update`` with the new values or ``invalidate``.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # user id -> (column values, time cached)
+        self.pins = Counter()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def load(self, user_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and (self.pins[user_id] or now - entry[1] < self.ttl):
+                self.hits += 1
+                values = dict(entry[0])
+            else:
+                self.misses += 1
+                values = None
+        if values is None:
+            user = User.query.get(user_id)
+            if user is not None:
+                self.put(user)
+            return user
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def put(self, user):
+        values = {attr.key: getattr(user, attr.key)
+                  for attr in sa_inspect(User).column_attrs}
+        with self.lock:
+            self.entries[user.id] = (values, time.monotonic())
+
+    def update(self, user_id, **values):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry:
+                entry[0].update(values)
+
+    def update_rows(self, rows):
+        """Apply ``persist_player_rows``-style dicts keyed by ``id``."""
+        with self.lock:
+            for row in rows:
+                entry = self.entries.get(row['id'])
+                if entry:
+                    entry[0].update((k, v) for k, v in row.items() if k != 'id')
+
+    def update_lobby(self, lobby_id, **values):
+        """Apply ``values`` to every cached user in ``lobby_id``."""
+        with self.lock:
+            for cached, _ in self.entries.values():
+                if cached['current_lobby'] == lobby_id:
+                    cached.update(values)
+
+    def username(self, user_id):
+        """Cached username, or None; never queries."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            return entry[0]['username'] if entry else None
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def pin(self, user_id):
+        with self.lock:
+            self.pins[user_id] += 1
+
+    def unpin(self, user_id):
+        with self.lock:
+            self.pins[user_id] -= 1
+            if self.pins[user_id] <= 0:
+                del self.pins[user_id]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'pinned': len(self.pins),
+                    'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = UserCache(app.config['USER_CACHE_TTL'])
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
+
+
+def request_user():
+    """Username for log lines, without loading the user just to log it.
+
+    Uses the user the request already loaded, else the session's user id
+    looked up in the cache only (e.g. a static file request that never
+    touched ``current_user``).
+    """
+    user = g.get('_login_user')
+    if user is not None:
+        return user.username if user.is_authenticated else None
+    user_id = session.get('_user_id')
+    if not user_id:
+        return None
+    return user_cache.username(int(user_id)) or f"#{user_id}"
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# ─── AVATAR PROCESSING ─────────────────────────────────────────────────────────
+
+AVATAR_FORMAT = 'webp' if features.check('webp') else 'png'
+# Processed avatars are named "<content hash>.<ext>"; each size is stored
+# next to it as "<content hash>_<size>.<ext>".
+HASHED_AVATAR = re.compile(r'^([0-9a-f]{32})\.(webp|png)$')
+
+avatar_pool = ThreadPoolExecutor(
+    max_workers=app.config['AVATAR_WORKERS'], thread_name_prefix='avatar'
+)
+
+
+def render_avatar_sizes(data, digest):
+    """Decode an upload and write every configured size under ``digest``.
+
+    The image is EXIF-rotated, centre-cropped to a square and re-encoded
+    from raw pixels, so no metadata from the upload survives.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGBA')
+    side = min(img.size)
+    img = ImageOps.fit(img, (side, side), Image.LANCZOS)
+    for size_name, px in app.config['AVATAR_SIZES'].items():
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{digest}_{size_name}.{AVATAR_FORMAT}")
+        if os.path.exists(path):
+            continue  # same content was processed before
+        tmp = f"{path}.tmp"
+        img.resize((px, px), Image.LANCZOS).save(tmp, AVATAR_FORMAT.upper())
+        os.replace(tmp, path)
+
+
+def process_avatar(user_id, data, filename):
+    """Worker-pool job: render the sizes, then point the user at them."""
+    digest = filename.split('.', 1)[0]
+    try:
+        run_blocking(render_avatar_sizes, data, digest)
+    except Exception:
+        logger.error(f"avatar PROCESS FAIL user_id={user_id}\n{traceback.format_exc()}")
+        return
+    with app.app_context():
+        try:
+            db.session.execute(db.update(User).where(User.id == user_id).values(avatar=filename))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.error(f"avatar SAVE FAIL user_id={user_id}\n{traceback.format_exc()}")
+            return
+    user_cache.update(user_id, avatar=filename)
+    ranking.update(user_id, {'avatar': filename})
+    for lobby in list(game_state['lobbies'].values()):
+        with lobby.lock:
+            if user_id in lobby.players:
+                lobby.players[user_id].avatar = filename
+    logger.info(f"avatar READY user_id={user_id} file={filename}")
+
+
+def avatar_path(filename, size):
+    """File to serve for ``filename`` at ``size``; legacy uploads have one size."""
+    match = HASHED_AVATAR.match(filename)
+    if not match:
+        return filename
+    if size not in app.config['AVATAR_SIZES']:
+        size = 'large'
+    return f"{match.group(1)}_{size}.{match.group(2)}"
+
+
+# ─── STATIC ASSETS ─────────────────────────────────────────────────────────────
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Asset:
+    """A servable file with a content hash and, for text, precompressed bodies."""
+
+    def __init__(self, name, mimetype, digest, path=None, variants=None):
+        self.name = name
+        self.mimetype = mimetype
+        self.digest = digest
+        self.path = path
+        self.variants = variants  # {None | 'gzip' | 'br': bytes} for text assets
+
+    @property
+    def version(self):
+        return self.digest[:12]
+
+    @property
+    def url(self):
+        return f"/static/{self.name}?v={self.version}"
+
+
+def build_text_asset(name, mimetype, data):
+    variants = {None: data, 'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return Asset(name, mimetype, hashlib.sha256(data).hexdigest(), variants=variants)
+
+
+def build_asset_manifest():
+    """Hash every file under static/ and precompress the rendered index page."""
+    manifest = {}
+    static_root = os.path.join(app.root_path, 'static')
+    for dirpath, _, files in os.walk(static_root):
+        for fname in files:
+            path = os.path.join(dirpath, fname)
+            name = os.path.relpath(path, static_root).replace(os.sep, '/')
+            mimetype = mimetypes.guess_type(fname)[0] or 'application/octet-stream'
+            with open(path, 'rb') as f:
+                data = f.read()
+            if mimetype.startswith(COMPRESSIBLE_TYPES):
+                manifest[name] = build_text_asset(name, mimetype, data)
+            else:
+                manifest[name] = Asset(name, mimetype, hashlib.sha256(data).hexdigest(), path=path)
+    with app.app_context():
+        page = render_template('index.html').encode()
+    index_page = build_text_asset('index.html', 'text/html', page)
+    return manifest, index_page
+
+
+def send_asset(asset, immutable=False):
+    """Send an asset with a strong content ETag, conditional/range support
+    and the best precompressed variant the client accepts."""
+    encoding = None
+    if asset.variants:
+        for candidate in ('br', 'gzip'):
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        body = io.BytesIO(asset.variants[encoding])
+        etag = f"{asset.digest}-{encoding}" if encoding else asset.digest
+    else:
+        body, etag = asset.path, asset.digest
+    # send_file marks the response direct_passthrough, so the request
+    # logger never tries to decode compressed bodies
+    response = send_file(body, mimetype=asset.mimetype, etag=etag,
+                         conditional=True, last_modified=None)
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    set_cache_policy(response, immutable)
+    return response
+
+
+def set_cache_policy(response, immutable):
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+
+# filled in by load_assets at startup
+assets, index_page = {}, None
+
+
+def load_assets():
+    global assets, index_page
+    assets, index_page = build_asset_manifest()
+
+
+def asset_url(name):
+    asset = assets.get(name)
+    return asset.url if asset else f"/static/{name}"
+
+
+# ─── LEADERBOARD ───────────────────────────────────────────────────────────────
+
+class Leaderboard:
+    """In-process ranking of every user by lifetime score.
+
+    ``_order`` holds (-lifetime_score, user id) in a ``SortedList``, so a
+    score change, a user's rank and the start of a top-N or windowed
+    slice each cost O(log n). It is loaded from the database on first use
+    and then kept current by the game handlers through ``update``. With
+    several workers it is
+    refreshed every ``SHARED_CACHE_TTL`` from the rows whose
+    ``updated_at`` moved since the last read, not from the whole table.
+    """
+
+    # a refresh re-reads rows changed this long before the previous one
+    # started: covers transactions still open then and clock skew between
+    # workers
+    SYNC_OVERLAP = 30
+
+    def __init__(self):
+        self._order = SortedList()
+        self._profiles = {}
+        self._loaded = False
+        self._synced_at = None
+        self._lock = threading.RLock()
+
+    def load(self, since=None):
+        """Read every user, or with ``since`` only rows updated since then."""
+        query = db.session.query(
+            User.id, User.username, User.avatar, User.lifetime_score,
+            User.kills, User.deaths, User.wins
+        )
+        if since is not None:
+            query = query.filter(User.updated_at >= since)
+        started = datetime.utcnow()
+        rows = query.all()
+        with self._lock:
+            if since is None:
+                self._profiles = {
+                    r.id: {
+                        'id': r.id,
+                        'username': r.username,
+                        'avatar': r.avatar,
+                        'score': r.lifetime_score or 0,
+                        'kills': r.kills or 0,
+                        'deaths': r.deaths or 0,
+                        'wins': r.wins or 0
+                    } for r in rows
+                }
+                self._order = SortedList((-p['score'], uid) for uid, p in self._profiles.items())
+            else:
+                for r in rows:
+                    self._apply(r.id, {
+                        'username': r.username, 'avatar': r.avatar,
+                        'lifetime_score': r.lifetime_score or 0,
+                        'kills': r.kills or 0, 'deaths': r.deaths or 0, 'wins': r.wins or 0
+                    })
+            self._synced_at = started - timedelta(seconds=self.SYNC_OVERLAP)
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        """Load on first use; with several workers, pick up their writes."""
+        if not self._loaded or shared_cache_stale(self._loaded_at):
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+                elif shared_cache_stale(self._loaded_at):
+                    self.load(since=self._synced_at)
+
+    def update(self, user_id, stats):
+        """Apply a user's new stats (a User-like mapping) to the ranking."""
+        self.ensure_loaded()
+        with self._lock:
+            self._apply(user_id, stats)
+
+    def _apply(self, user_id, stats):
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            profile = self._profiles[user_id] = {
+                'id': user_id, 'username': None, 'avatar': None,
+                'score': 0, 'kills': 0, 'deaths': 0, 'wins': 0
+            }
+            self._order.add((0, user_id))
+        old_key = (-profile['score'], user_id)
+        for field in ('username', 'avatar', 'kills', 'deaths', 'wins'):
+            if field in stats:
+                profile[field] = stats[field]
+        if 'lifetime_score' in stats and stats['lifetime_score'] != profile['score']:
+            profile['score'] = stats['lifetime_score']
+            self._order.remove(old_key)
+            self._order.add((-profile['score'], user_id))
+
+    def _entries(self, start, stop):
+        start = max(start, 0)
+        return [dict(self._profiles[uid], rank=start + i + 1)
+                for i, (_, uid) in enumerate(self._order[start:stop])]
+
+    def top(self, limit, offset=0):
+        self.ensure_loaded()
+        with self._lock:
+            return self._entries(offset, offset + limit)
+
+    def rank(self, user_id):
+        """1-based rank of ``user_id``, or None for an unknown user."""
+        self.ensure_loaded()
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is None:
+                return None
+            return self._order.bisect_left((-profile['score'], user_id)) + 1
+
+    def around(self, user_id, limit):
+        """A window of ``limit`` entries centred on ``user_id``."""
+        with self._lock:
+            rank = self.rank(user_id)
+            if rank is None:
+                return []
+            start = max(rank - 1 - limit // 2, 0)
+            return self._entries(start, start + limit)
+
+
+ranking = Leaderboard()
+
+
+def publish_scores(lobby, user_ids):
+    """Push the in-memory stats of ``user_ids`` into the ranking."""
+    with lobby.lock:
+        stats = [(uid, lobby.players[uid].to_dict()) for uid in user_ids if uid in lobby.players]
+    for uid, record in stats:
+        ranking.update(uid, record)
+
+
+# ─── LOBBY DIRECTORY ───────────────────────────────────────────────────────────
+
+class LobbyDirectory:
+    """Name, capacity and member count of every lobby, held in memory.
+
+    Loaded with one aggregated query on first use, then kept current by
+    lobby creation, joins and leaves. Every change is pushed as a
+    ``lobby_event`` to sockets in the ``lobby_list`` room, so the lobby
+    screen never has to poll ``/lobbies``.
+
+    Joins take their seat with ``reserve``, which checks capacity and
+    counts the seat under one lock, so concurrent joins can't overfill a
+    lobby. A seat is in flight until the join's commit reports it with
+    ``joined``: seats held for a player the matchmaker placed but who
+    hasn't joined yet, and seats taken by a join still writing
+    ``current_lobby``. A reload (every ``SHARED_CACHE_TTL`` with several
+    workers) adds those to the database counts, under the same lock, so
+    it never gives away a seat that is about to be committed. Leaves give
+    their seat back before committing, so a reload in between can only
+    overcount until the next one.
+    """
+
+    def __init__(self):
+        self._lobbies = {}
+        self._emptied = {}  # lobby id -> monotonic time it last had no members
+        self._held = Counter()  # lobby id -> seats reserved but not yet joined
+        self._joining = Counter()  # lobby id -> seats taken, join not committed
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        now = time.monotonic()
+        with self._lock:
+            rows = db.session.query(
+                Lobby.id, Lobby.name, Lobby.max_players, db.func.count(User.id)
+            ).outerjoin(User, User.current_lobby == Lobby.id).group_by(
+                Lobby.id, Lobby.name, Lobby.max_players
+            ).all()
+            self._lobbies = {
+                lobby_id: {'id': lobby_id, 'name': name,
+                           'player_count': count + self._held[lobby_id] + self._joining[lobby_id],
+                           'max_players': max_players}
+                for lobby_id, name, max_players, count in rows
+            }
+            self._emptied = {lobby_id: self._emptied.get(lobby_id, now)
+                             for lobby_id, summary in self._lobbies.items()
+                             if summary['player_count'] == 0}
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if not self._loaded or shared_cache_stale(self._loaded_at):
+            with self._lock:
+                if not self._loaded or shared_cache_stale(self._loaded_at):
+                    self.load()
+
+    def all(self):
+        self.ensure_loaded()
+        with self._lock:
+            return [dict(summary) for summary in self._lobbies.values()]
+
+    def get(self, lobby_id):
+        self.ensure_loaded()
+        with self._lock:
+            summary = self._lobbies.get(lobby_id)
+            return dict(summary) if summary else None
+
+    def add(self, lobby):
+        self.ensure_loaded()
+        with self._lock:
+            summary = self._lobbies[lobby.id] = {
+                'id': lobby.id, 'name': lobby.name,
+                'player_count': 0, 'max_players': lobby.max_players
+            }
+            self._emptied[lobby.id] = time.monotonic()
+            summary = dict(summary)
+        announce_lobby('created', summary)
+
+    def remove(self, lobby_id):
+        with self._lock:
+            summary = self._lobbies.pop(lobby_id, None)
+            self._emptied.pop(lobby_id, None)
+            self._held.pop(lobby_id, None)
+            self._joining.pop(lobby_id, None)
+        if summary is not None:
+            announce_lobby('removed', summary)
+
+    def idle(self, min_age):
+        """Ids of lobbies that have had no members for ``min_age`` seconds."""
+        self.ensure_loaded()
+        now = time.monotonic()
+        with self._lock:
+            return [lobby_id for lobby_id, since in self._emptied.items()
+                    if now - since >= min_age]
+
+    def adjust(self, lobby_id, delta):
+        """Change a lobby's member count by ``delta`` and announce it."""
+        self.ensure_loaded()
+        with self._lock:
+            summary = self._change(lobby_id, delta)
+        if summary is not None:
+            self._announce(summary)
+
+    def reserve(self, lobby_id, hold=False):
+        """Take a seat if the lobby has one free; returns whether it did.
+
+        With ``hold`` the seat is kept for a player who hasn't joined yet,
+        until ``claim`` or ``release``.
+        """
+        self.ensure_loaded()
+        with self._lock:
+            summary = self._lobbies.get(lobby_id)
+            if summary is None or summary['player_count'] >= summary['max_players']:
+                return False
+            (self._held if hold else self._joining)[lobby_id] += 1
+            summary = self._change(lobby_id, +1)
+        self._announce(summary)
+        return True
+
+    def claim(self, lobby_id):
+        """Turn a held seat into a joining one; False if none was held."""
+        with self._lock:
+            if not self._take(self._held, lobby_id):
+                return False
+            self._joining[lobby_id] += 1
+            return True
+
+    def joined(self, lobby_id):
+        """The join that took a seat has committed; the DB counts it now."""
+        with self._lock:
+            self._take(self._joining, lobby_id)
+
+    def release(self, lobby_id):
+        """Give back a held seat that was never claimed."""
+        with self._lock:
+            released = self._take(self._held, lobby_id)
+        if released:
+            self.adjust(lobby_id, -1)
+
+    @staticmethod
+    def _take(seats, lobby_id):
+        if seats[lobby_id] <= 0:
+            return False
+        seats[lobby_id] -= 1
+        if not seats[lobby_id]:
+            del seats[lobby_id]
+        return True
+
+    def _change(self, lobby_id, delta):
+        summary = self._lobbies.get(lobby_id)
+        if summary is None:
+            return None
+        summary['player_count'] = max(summary['player_count'] + delta, 0)
+        if summary['player_count'] == 0:
+            self._emptied.setdefault(lobby_id, time.monotonic())
+        else:
+            self._emptied.pop(lobby_id, None)
+        return dict(summary)
+
+    @staticmethod
+    def _announce(summary):
+        if summary['player_count'] == 0:
+            kind = 'emptied'
+        elif summary['player_count'] >= summary['max_players']:
+            kind = 'filled'
+        else:
+            kind = 'updated'
+        announce_lobby(kind, summary)
+
+
+def announce_lobby(kind, summary):
+    socketio.emit('lobby_event', {'type': kind, 'lobby': summary}, to='lobby_list')
+
+
+lobby_directory = LobbyDirectory()
+
+
 # ─── FLASK ROUTES ──────────────────────────────────────────────────────────────
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return send_asset(index_page)
+
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    """Static files; ``?v=<content hash>`` URLs are cached as immutable."""
+    asset = assets.get(filename)
+    if asset is None:
+        return jsonify({'error': 'Not found'}), 404
+    return send_asset(asset, immutable=request.args.get('v') == asset.version)
 
 
 @app.route('/register', methods=['POST'])
@@ -206,14 +1517,23 @@ def register():
     username = data.get('username')
     # never log data.get('password')
 
+    if not auth_allowed(username):
+        logger.warning(f"register THROTTLED username={username}")
+        return jsonify({'error': 'Too many attempts, try again later'}), 429
+
     if User.query.filter_by(username=username).first():
         logger.info(f"register FAIL username={username} — already exists")
         return jsonify({'error': 'Username already exists'}), 400
 
     user = User(username=username)
-    user.set_password(data.get('password'))
+    try:
+        user.set_password(data.get('password'))
+    except PasswordHasherBusy:
+        logger.warning(f"register BUSY username={username}")
+        return jsonify({'error': 'Server busy, try again later'}), 503
     db.session.add(user)
     db.session.commit()
+    ranking.update(user.id, {'username': user.username, 'lifetime_score': 0})
     logger.info(f"register SUCCESS username={username}")
     return jsonify({'message': 'Registration successful'}), 201
 
@@ -224,17 +1544,27 @@ def login():
     username = data.get('username')
     # do NOT log the password
 
+    if not auth_allowed(username):
+        logger.warning(f"login THROTTLED username={username}")
+        return jsonify({'error': 'Too many attempts, try again later'}), 429
+
     user = User.query.filter_by(username=username).first()
     if not user:
         logger.warning(f"login FAIL username={username} — user not found")
         return jsonify({'error': 'Invalid username or password'}), 401
 
-    if not user.check_password(data.get('password')):
+    try:
+        password_ok = user.check_password(data.get('password'))
+    except PasswordHasherBusy:
+        logger.warning(f"login BUSY username={username}")
+        return jsonify({'error': 'Server busy, try again later'}), 503
+    if not password_ok:
         logger.warning(f"login FAIL username={username} — wrong password")
         return jsonify({'error': 'Invalid username or password'}), 401
 
     login_user(user)
     db.session.commit()
+    user_cache.invalidate(user.id)
     logger.info(f"login SUCCESS username={username}")
     return jsonify({'message': 'Login successful'}), 200
 
@@ -257,38 +1587,60 @@ def upload_avatar():
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     if file and allowed_file(file.filename):
-        filename = secure_filename(f"{current_user.id}_{file.filename}")
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        current_user.avatar = filename
-        db.session.commit()
+        data = file.read()
+        filename = f"{hashlib.sha256(data).hexdigest()[:32]}.{AVATAR_FORMAT}"
+        # decoding and resizing happen in the worker pool; the user's
+        # avatar switches over once every size has been written
+        avatar_pool.submit(process_avatar, current_user.id, data, filename)
         logger.info(f"avatar UPLOAD username={current_user.username} file={filename}")
-        return jsonify({'message': 'Avatar uploaded successfully', 'filename': filename})
+        return jsonify({'message': 'Avatar uploaded successfully', 'filename': filename}), 202
     return jsonify({'error': 'Invalid file type'}), 400
 
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve an avatar; ``?size=cell|small|large`` picks the rendition."""
+    path = avatar_path(filename, request.args.get('size', 'large'))
+    hashed = path != filename
+    response = send_from_directory(
+        app.config['UPLOAD_FOLDER'], path,
+        # a processed avatar's name is its content hash, so it never changes
+        etag=path.rsplit('.', 1)[0] if hashed else True
+    )
+    set_cache_policy(response, immutable=hashed)
+    return response
 
 
 @app.route('/leaderboard')
 def leaderboard():
-    users = User.query.order_by(User.lifetime_score.desc()).limit(10).all()
-    return jsonify([u.to_dict() for u in users])
+    """Ranked users: ``?limit=&offset=`` pages, ``?around=<user id>`` windows."""
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    offset = request.args.get('offset', 0, type=int)
+    around = request.args.get('around', type=int)
+
+    if around is not None:
+        entries = ranking.around(around, limit)
+    else:
+        entries = ranking.top(limit, offset)
+    # the ETag hashes the page itself, so it agrees across workers and restarts
+    response = jsonify(entries)
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+@app.route('/leaderboard/rank/<int:user_id>')
+def leaderboard_rank(user_id):
+    rank = ranking.rank(user_id)
+    if rank is None:
+        return jsonify({'error': 'User not found'}), 404
+    return jsonify({'user_id': user_id, 'rank': rank})
 
 
 @app.route('/lobbies')
 @login_required
 def get_lobbies():
-    lobbies = Lobby.query.all()
-    return jsonify([
-        {
-            'id': l.id,
-            'name': l.name,
-            'player_count': len(l.players),
-            'max_players': l.max_players
-        } for l in lobbies
-    ])
+    return jsonify(lobby_directory.all())
 
 
 @app.route('/lobbies', methods=['POST'])
@@ -296,10 +1648,15 @@ def get_lobbies():
 def create_lobby():
     data = request.get_json()
     name = data.get('name')
-    max_players = data.get('max_players', 4)
+    try:
+        max_players = int(data.get('max_players', 4))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_players must be a number'}), 400
+    max_players = min(max(max_players, 1), app.config['MAX_LOBBY_PLAYERS'])
     lobby = Lobby(name=name, max_players=max_players)
     db.session.add(lobby)
     db.session.commit()
+    lobby_directory.add(lobby)
     return jsonify({
         'id': lobby.id,
         'name': lobby.name,
@@ -307,6 +1664,58 @@ def create_lobby():
     }), 201
 
 
+@app.route('/stats/http')
+def http_stats():
+    """Per-route latency histograms and log pipeline health."""
+    with http_latency_lock:
+        routes = {rule: h.to_dict() for rule, h in http_latency.items()}
+    return jsonify({
+        'routes': routes,
+        'log_queue_depth': log_queue.qsize(),
+        'log_records_dropped': queue_handler.dropped,
+        'user_cache': user_cache.stats()
+    })
+
+
+@app.route('/stats/input')
+def input_stats():
+    """Accepted, dropped, coalesced and cooldown-rejected socket events."""
+    return jsonify({**input_limiter.stats(),
+                    'auth': auth_limiter.stats(),
+                    'password_hasher': password_hasher.stats()})
+
+
+@app.route('/stats/lobbies')
+def lobby_stats():
+    """Approximate memory held by each in-memory lobby, and in total."""
+    return jsonify(dict(lobby_memory(), matchmaking=matchmaker.stats()))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """All counters, histograms and gauges in the Prometheus text format."""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample stacks for ``?seconds=`` and return them as collapsed stacks.
+
+    Feed the output to flamegraph.pl or speedscope. Disabled unless
+    PROFILER_ENABLED is set.
+    """
+    if not app.config['PROFILER_ENABLED']:
+        return jsonify({'error': 'Not found'}), 404
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), 120)
+    interval = min(max(request.args.get('interval', 0.005, type=float), 0.001), 1)
+    try:
+        stacks = profiler.profile(seconds, interval)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    logger.info(f"profile recorded seconds={seconds} interval={interval}")
+    return stacks, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
 @app.route('/achievements')
 def get_achievements():
     achs = Achievement.query.all()
@@ -322,256 +1731,1957 @@ def get_achievements():
             'name': a.name,
             'description': a.description,
             'icon': a.icon,
+            'icon_url': asset_url(a.icon) if a.icon else None,
             'achieved': a.id in achieved_ids
         } for a in achs
     ])
 
 
-# ─── SOCKET.IO EVENTS ──────────────────────────────────────────────────────────
+# ─── MATCH REPLAY ──────────────────────────────────────────────────────────────
+#
+# Each match (from the first player joining or the previous win until the
+# next win) is logged to its own append-only file in REPLAY_DIR. The file
+# starts with REPLAY_HEADER; after that every record is a RECORD_HEADER
+# (body length, kind, tick) followed by its body. ``tick`` is the lobby's
+# last completed tick when the record was made:
+#
+#   SNAPSHOT  count:H, then per player REPLAY_PLAYER + name length:B + name
+#   JOIN      REPLAY_PLAYER + name length:B + name
+#   LEAVE     id:I
+#   MOVE      REPLAY_MOVE, a move the following tick applied
+#   ATTACK    REPLAY_ATTACK, an accepted attack input (dx = dy = 0 for melee)
+#   HIT       REPLAY_HIT, damage dealt; flags bit 0 = killed, bit 1 = won
+#   STATE     count:H, then REPLAY_PLAYER per player changed by the tick
+#   END       winner id:I
+#
+# A SNAPSHOT is written at the start of a match and every
+# REPLAY_SNAPSHOT_INTERVAL ticks, so a reader can seek by skipping record
+# bodies to the last snapshot before a tick. replay.py reads these files.
+
+REPLAY_MAGIC, REPLAY_VERSION = b'OATR', 1
+# magic, version, lobby id, match number, tick rate, grid w/h, start (unix time)
+REPLAY_HEADER = struct.Struct('<4sBIIfHHd')
+RECORD_HEADER = struct.Struct('<IBI')
+(REC_SNAPSHOT, REC_JOIN, REC_LEAVE, REC_MOVE, REC_ATTACK,
+ REC_HIT, REC_STATE, REC_END) = range(1, 9)
+# id, x, y, health, score, lifetime_score, kills, deaths, wins
+REPLAY_PLAYER = struct.Struct('<IhhhIIHII')
+REPLAY_MOVE = struct.Struct('<Ihh')
+REPLAY_ATTACK = struct.Struct('<Ibb')
+REPLAY_HIT = struct.Struct('<IIhB')
+REPLAY_ID = struct.Struct('<I')
+REPLAY_COUNT = struct.Struct('<H')
+
+
+def pack_replay_player(pid, p, named=False):
+    body = REPLAY_PLAYER.pack(pid, p.x, p.y, p.health, p.score,
+                              p.lifetime_score, p.kills, p.deaths, p.wins)
+    if named:
+        name = (p.username or '').encode()[:255]
+        body += bytes((len(name),)) + name
+    return body
+
+
+class MatchRecorder:
+    """Encodes a lobby's match log into memory for ``replay_flush_loop``.
+
+    Methods are called under the lobby's lock and only pack bytes onto a
+    buffer; files are opened and written by the flush task, never on the
+    tick or in a socket handler, and nothing goes to the database. A log
+    is only started once the lobby has players, so a lobby nobody plays
+    in leaves no file behind.
+    """
+
+    def __init__(self, lobby_id, tick_rate, width, height):
+        self.enabled = bool(app.config['REPLAY_DIR'])
+        self.lobby_id = lobby_id
+        self.tick_rate = tick_rate
+        self.width, self.height = width, height
+        self.match = 0
+        self.path = None
+        self.buffer = bytearray()
+        self.sealed = []  # (path, bytes) of finished matches not yet written
+        self.lock = threading.Lock()
+
+    @property
+    def recording(self):
+        return self.path is not None
+
+    def start_match(self, tick, players):
+        if not self.enabled:
+            return
+        self.match += 1
+        started = time.time()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(started))
+        name = f"lobby{self.lobby_id}-{stamp}-{self.match}.replay"
+        with self.lock:
+            self.path = os.path.join(app.config['REPLAY_DIR'], name)
+            self.buffer += REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.lobby_id,
+                                              self.match, self.tick_rate,
+                                              self.width, self.height, started)
+        self.snapshot(tick, players)
+
+    def end_match(self, tick, winner_id, players):
+        """Close the current match's log and start the next one, if anyone is left."""
+        if not self.recording:
+            return
+        self._append(REC_END, tick, REPLAY_ID.pack(winner_id))
+        with self.lock:
+            self.sealed.append((self.path, bytes(self.buffer)))
+            self.buffer.clear()
+            self.path = None
+        if players:
+            self.start_match(tick, players)
+
+    def snapshot(self, tick, players):
+        if not self.recording:
+            return
+        self._append(REC_SNAPSHOT, tick, REPLAY_COUNT.pack(len(players)) + b''.join(
+            pack_replay_player(pid, p, named=True) for pid, p in players.items()))
+
+    def joined(self, tick, pid, record):
+        if self.recording:
+            self._append(REC_JOIN, tick, pack_replay_player(pid, record, named=True))
+
+    def left(self, tick, pid):
+        if self.recording:
+            self._append(REC_LEAVE, tick, REPLAY_ID.pack(pid))
+
+    def move(self, tick, pid, x, y):
+        if self.recording:
+            self._append(REC_MOVE, tick, REPLAY_MOVE.pack(pid, x, y))
+
+    def attack(self, tick, pid, dx=0, dy=0):
+        if self.recording:
+            self._append(REC_ATTACK, tick, REPLAY_ATTACK.pack(pid, dx, dy))
+
+    def hit(self, tick, attacker_id, target_id, damage, killed, won):
+        if self.recording:
+            self._append(REC_HIT, tick, REPLAY_HIT.pack(attacker_id, target_id, damage,
+                                                        killed | won << 1))
+
+    def state(self, tick, players):
+        if self.recording and players:
+            self._append(REC_STATE, tick, REPLAY_COUNT.pack(len(players)) + b''.join(
+                pack_replay_player(pid, p) for pid, p in players.items()))
+
+    def _append(self, kind, tick, body):
+        with self.lock:
+            self.buffer += RECORD_HEADER.pack(len(body), kind, tick)
+            self.buffer += body
+
+    def drain(self):
+        """Take everything recorded so far as ``[(path, bytes), ...]``."""
+        with self.lock:
+            chunks, self.sealed = self.sealed, []
+            if self.buffer:
+                chunks.append((self.path, bytes(self.buffer)))
+                self.buffer.clear()
+            return chunks
+
+
+replay_stats = Counter()  # bytes written, failed writes, files pruned
+
+
+def write_replay_chunks(chunks):
+    os.makedirs(app.config['REPLAY_DIR'], exist_ok=True)
+    for path, data in chunks:
+        with open(path, 'ab') as f:
+            f.write(data)
+        replay_stats['bytes'] += len(data)
+
+
+def prune_replays(keep):
+    """Delete replay logs beyond REPLAY_MAX_FILES or older than REPLAY_MAX_AGE.
+
+    ``keep`` holds the paths of matches still being recorded; those are
+    never removed. Returns how many files were deleted.
+    """
+    replay_dir = app.config['REPLAY_DIR']
+    max_files, max_age = app.config['REPLAY_MAX_FILES'], app.config['REPLAY_MAX_AGE']
+    try:
+        entries = [e for e in os.scandir(replay_dir)
+                   if e.name.endswith('.replay') and e.path not in keep]
+    except FileNotFoundError:
+        return 0
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    cutoff = time.time() - max_age
+    pruned = 0
+    for i, entry in enumerate(entries):
+        if (max_files and i >= max_files) or (max_age and entry.stat().st_mtime < cutoff):
+            try:
+                os.remove(entry.path)
+                pruned += 1
+            except FileNotFoundError:
+                pass
+    return pruned
+
+
+def flush_replays():
+    chunks = [c for lobby in list(game_state['lobbies'].values())
+              for c in lobby.replay.drain()]
+    if chunks:
+        try:
+            run_blocking(write_replay_chunks, chunks)
+        except OSError:
+            replay_stats['errors'] += 1
+            logger.error(f"Replay write failed\n{traceback.format_exc()}")
+
+
+def replay_flush_loop():
+    """Background task: append buffered match logs to their files."""
+    while True:
+        socketio.sleep(app.config['REPLAY_FLUSH_INTERVAL'])
+        flush_replays()
+
+
+atexit.register(flush_replays)
+
+
+# ─── IN-MEMORY GAME STATE ──────────────────────────────────────────────────────
+
+# Fields of a player record that are written back to the User table
+PERSISTED_STATS = ('health', 'score', 'lifetime_score', 'kills', 'deaths', 'wins')
+# Fields of a player record that are broadcast to clients each tick
+BROADCAST_FIELDS = ('username', 'avatar', 'position', 'health',
+                    'lifetime_score', 'kills', 'deaths', 'wins')
+
+
+class PlayerRecord:
+    """In-memory state of one player in a lobby, built from their User row.
+
+    Slots instead of nested dicts keep a record to a fraction of the size;
+    ``to_dict`` gives the serializable form sent to clients. ``seen`` is
+    when the player last had a socket in the lobby, and ``melee_at`` /
+    ``ranged_at`` when they last attacked (for ATTACK_COOLDOWNS).
+    """
+    __slots__ = ('username', 'avatar', 'x', 'y', 'health', 'score', 'lifetime_score',
+                 'kills', 'deaths', 'wins', 'seen', 'melee_at', 'ranged_at')
+
+    def __init__(self, user):
+        self.username = user.username
+        self.avatar = user.avatar
+        self.x, self.y = user.pos_x or 0, user.pos_y or 0
+        self.health = user.health
+        self.score = user.score
+        self.lifetime_score = user.lifetime_score
+        self.kills = user.kills
+        self.deaths = user.deaths
+        self.wins = user.wins
+        self.seen = time.monotonic()
+        self.melee_at = self.ranged_at = None
+
+    @property
+    def position(self):
+        return {'x': self.x, 'y': self.y}
+
+    def to_dict(self):
+        return {
+            'username': self.username,
+            'avatar': self.avatar,
+            'position': {'x': self.x, 'y': self.y},
+            'health': self.health,
+            'score': self.score,
+            'lifetime_score': self.lifetime_score,
+            'kills': self.kills,
+            'deaths': self.deaths,
+            'wins': self.wins
+        }
+
+    def changed_fields(self, last):
+        """BROADCAST_FIELDS whose value differs from the dict ``last`` (all if None)."""
+        fields = {}
+        for f in BROADCAST_FIELDS:
+            if f == 'position':
+                pos = last and last['position']
+                if pos is None or pos['x'] != self.x or pos['y'] != self.y:
+                    fields['position'] = {'x': self.x, 'y': self.y}
+            else:
+                value = getattr(self, f)
+                if last is None or last[f] != value:
+                    fields[f] = value
+        return fields
+
+
+# unit step per facing direction for ranged attacks
+DIRECTIONS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+
+
+class Projectile:
+    """A ranged shot in flight; moves one cell per unit of ``progress``."""
+    __slots__ = ('id', 'owner', 'x', 'y', 'dx', 'dy', 'progress', 'cells_left')
+
+    def __init__(self, projectile_id, owner, x, y, dx, dy, cells):
+        self.id = projectile_id
+        self.owner = owner
+        self.x, self.y = x, y
+        self.dx, self.dy = dx, dy
+        self.progress = 0.0
+        self.cells_left = cells
+
+
+HitResult = namedtuple('HitResult', 'attacker_id target_id killed won unlocked')
+
+
+class SpatialGrid:
+    """Cell -> occupant index for a lobby's arena, plus a pool of free cells.
+
+    Free cells are kept in an unordered array with a reverse index, so
+    claiming, releasing and picking a random free cell are all O(1)
+    regardless of grid size.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.occupants = {}
+        self._free = array('i', range(width * height))
+        self._slot = array('i', range(width * height))  # cell -> index in _free
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def occupant(self, x, y):
+        return self.occupants.get((x, y))
+
+    def add(self, x, y, player_id):
+        cell = y * self.width + x
+        slot = self._slot[cell]
+        if slot < 0:
+            raise ValueError(f"cell ({x}, {y}) is already occupied")
+        last = self._free.pop()
+        if last != cell:
+            self._free[slot] = last
+            self._slot[last] = slot
+        self._slot[cell] = -1
+        self.occupants[(x, y)] = player_id
+
+    def remove(self, x, y):
+        if self.occupants.pop((x, y), None) is None:
+            return
+        cell = y * self.width + x
+        self._slot[cell] = len(self._free)
+        self._free.append(cell)
+
+    def nbytes(self):
+        """Approximate memory held by the index and the free-cell pool."""
+        return (sys.getsizeof(self.occupants) + sys.getsizeof(self._free)
+                + sys.getsizeof(self._slot) + sum(sys.getsizeof(c) for c in self.occupants))
+
+    def random_free(self):
+        """A uniformly random empty cell, or None if the grid is full."""
+        if not self._free:
+            return None
+        cell = self._free[random.randrange(len(self._free))]
+        return cell % self.width, cell // self.width
+
+    def within(self, x, y, radius):
+        """Occupants within Chebyshev distance ``radius`` of (x, y), nearest first.
+
+        Scans whichever is smaller: the cells of the query square or the
+        list of occupants.
+        """
+        x0, x1 = max(x - radius, 0), min(x + radius, self.width - 1)
+        y0, y1 = max(y - radius, 0), min(y + radius, self.height - 1)
+        if x0 > x1 or y0 > y1:
+            return []
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self.occupants):
+            found = [(cx, cy) for cx in range(x0, x1 + 1)
+                     for cy in range(y0, y1 + 1) if (cx, cy) in self.occupants]
+        else:
+            found = [c for c in self.occupants
+                     if x0 <= c[0] <= x1 and y0 <= c[1] <= y1]
+        found.sort(key=lambda c: max(abs(c[0] - x), abs(c[1] - y)))
+        return [self.occupants[c] for c in found]
+
+
+class LobbyState:
+    """Authoritative state of one lobby while its players are connected.
+
+    Positions and combat stats are read and written here instead of the
+    database; ``grid`` indexes which player stands on each cell so
+    collision, hit and respawn queries never scan the player list.
+    Changed players are tracked in ``dirty`` and written back in batches
+    by ``flush_lobby_state``.
+    Combat is applied under ``lock``, which does the job row locks would
+    in the database: concurrent hits on one target are applied in turn
+    and none of their health updates is lost.
+
+    Movement input is queued in ``pending_moves`` and applied by
+    ``run_tick``, which broadcasts only what changed since the previous
+    broadcast (``sent``, as of tick ``sent_tick``).
+    """
+
+    def __init__(self, lobby_id, tick_rate=None):
+        self.id = lobby_id
+        self.players = {}
+        self.grid = SpatialGrid(app.config['GRID_WIDTH'], app.config['GRID_HEIGHT'])
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.tick_rate = tick_rate or app.config['TICK_RATE']
+        self.tick = 0
+        self.next_tick = time.monotonic()
+        self.pending_moves = {}
+        self.sent = {}
+        self.sent_tick = 0
+        self.force_keyframe = True
+        self.projectiles = []
+        self.next_projectile_id = 1
+        self.replay = MatchRecorder(lobby_id, self.tick_rate,
+                                    self.grid.width, self.grid.height)
+        # sockets in this lobby's state rooms, per wire codec
+        self.codecs = Counter()
+        # area of interest (VIEW_RADIUS): per viewing player, their socket,
+        # who they currently see and the last tick they were sent
+        self.view_radius = app.config['VIEW_RADIUS']
+        self.viewers = {}
+        self.visible = {}
+        self.viewer_tick = {}
+        # lifecycle: members who disconnected without leaving (user id ->
+        # when), and since when the lobby has had no players
+        self.departed = {}
+        self.empty_since = time.monotonic()
+        # a won game's score reset and earned achievements that a failed
+        # flush left for the next one; guarded by flush_lock
+        self.pending_reset = False
+        self.pending_achievements = []
+
+    def add_player(self, user):
+        with self.lock:
+            if user.id in self.players:
+                return
+            record = PlayerRecord(user)
+            cell = (record.x, record.y)
+            if not self.grid.in_bounds(*cell) or self.grid.occupant(*cell) is not None:
+                cell = self.grid.random_free() or (0, 0)
+                record.x, record.y = cell
+                self.dirty.add(user.id)
+            self.players[user.id] = record
+            self.departed.pop(user.id, None)
+            self.empty_since = None
+            if self.grid.occupant(*cell) is None:
+                self.grid.add(cell[0], cell[1], user.id)
+            if self.replay.recording:
+                self.replay.joined(self.tick, user.id, record)
+            else:
+                # the first player in opens the match log
+                self.replay.start_match(self.tick, self.players)
+
+    def pop_player(self, user_id):
+        """Remove a player; return their DB row if it had unsaved changes."""
+        with self.lock:
+            record = self.players.pop(user_id, None)
+            if record is None:
+                return None
+            if self.grid.occupant(record.x, record.y) == user_id:
+                self.grid.remove(record.x, record.y)
+            self.pending_moves.pop(user_id, None)
+            self.replay.left(self.tick, user_id)
+            if not self.players:
+                self.empty_since = time.monotonic()
+            if user_id in self.dirty:
+                self.dirty.discard(user_id)
+                return self._db_row(user_id, record)
+            return None
+
+    def place_player(self, user_id, x, y):
+        """Put a player on (x, y) if that cell is free. Returns success."""
+        with self.lock:
+            record = self.players.get(user_id)
+            if record is None or not self.grid.in_bounds(x, y):
+                return False
+            occupant = self.grid.occupant(x, y)
+            if occupant == user_id:
+                return True
+            if occupant is not None:
+                return False
+            if self.grid.occupant(record.x, record.y) == user_id:
+                self.grid.remove(record.x, record.y)
+            self.grid.add(x, y, user_id)
+            record.x, record.y = x, y
+            self.dirty.add(user_id)
+            return True
+
+    def queue_move(self, user_id, x, y):
+        """Record a move for the next tick; later moves replace earlier ones.
+
+        Moves off the grid are dropped here. Returns True when an earlier,
+        not yet applied move was replaced.
+        """
+        with self.lock:
+            if user_id in self.players and self.grid.in_bounds(x, y):
+                coalesced = self.pending_moves.pop(user_id, None) is not None
+                self.pending_moves[user_id] = (x, y)
+                return coalesced
+            return False
+
+    def apply_pending_moves(self):
+        with self.lock:
+            moves, self.pending_moves = self.pending_moves, {}
+            for user_id, (x, y) in moves.items():
+                if self.place_player(user_id, x, y):
+                    self.replay.move(self.tick, user_id, x, y)
+
+    def fire_projectile(self, user_id, dx, dy):
+        """Launch a shot from ``user_id``'s cell; returns it, or None."""
+        with self.lock:
+            record = self.players.get(user_id)
+            if record is None:
+                return None
+            projectile = Projectile(
+                self.next_projectile_id, user_id,
+                record.x, record.y, dx, dy, app.config['PROJECTILE_RANGE']
+            )
+            self.next_projectile_id += 1
+            self.projectiles.append(projectile)
+            self.replay.attack(self.tick, user_id, dx, dy)
+            return projectile
+
+    def step_projectiles(self):
+        """Advance every projectile by one tick of flight.
+
+        Each shot is ray-marched cell by cell through ``grid``, so a fast
+        projectile can't skip over a player between ticks. Returns
+        ``(projectile, target_id)`` for every shot that stopped this tick;
+        ``target_id`` is None when it left the arena or ran out of range.
+        """
+        with self.lock:
+            cells_per_tick = app.config['PROJECTILE_SPEED'] / self.tick_rate
+            stopped, flying = [], []
+            for p in self.projectiles:
+                p.progress += cells_per_tick
+                target = None
+                while p.progress >= 1.0 and p.cells_left > 0:
+                    p.progress -= 1.0
+                    nx, ny = p.x + p.dx, p.y + p.dy
+                    if not self.grid.in_bounds(nx, ny):
+                        p.cells_left = 0
+                        break
+                    p.x, p.y = nx, ny
+                    p.cells_left -= 1
+                    occupant = self.grid.occupant(nx, ny)
+                    if occupant is not None and occupant != p.owner:
+                        target = occupant
+                        break
+                if target is not None or p.cells_left == 0:
+                    stopped.append((p, target))
+                else:
+                    flying.append(p)
+            self.projectiles = flying
+            return stopped
+
+    def apply_hit(self, attacker_id, target_id, damage):
+        """Deal ``damage`` and handle the kill/win rules; returns a HitResult.
+
+        Only updates the in-memory state. The caller passes the results to
+        ``settle_hits`` once the lock is released.
+        """
+        with self.lock:
+            attacker = self.players.get(attacker_id)
+            target = self.players.get(target_id)
+            if attacker is None or target is None:
+                return None
+            killed = won = False
+            unlocked = []
+            target.health -= damage
+            if target.health <= 0:
+                killed = True
+                attacker.kills += 1
+                attacker.score += 100
+                attacker.lifetime_score += 100
+                target.deaths += 1
+                target.health = 100
+
+                rx, ry = self.grid.random_free() or (0, 0)
+                self.place_player(target_id, rx, ry)
+
+                unlocked = check_achievements(attacker_id, attacker, ('kills', 'score'))
+
+                # --- WIN CONDITION: first to 10 kills ---
+                if attacker.kills >= 10:
+                    attacker.wins += 1
+                    attacker.lifetime_score += 500  # Bonus points for winning
+                    unlocked += check_achievements(attacker_id, attacker, ('wins',))
+                    # Reset only the current game scores, not lifetime
+                    # scores; settle_hits writes it as one bulk UPDATE
+                    for p in self.players.values():
+                        p.kills = 0
+                        p.score = 0
+                    won = True
+            self.replay.hit(self.tick, attacker_id, target_id, damage, killed, won)
+            if won:
+                self.replay.end_match(self.tick, attacker_id, self.players)
+            self.dirty.update((attacker_id, target_id))
+            return HitResult(attacker_id, target_id, killed, won, unlocked)
+
+    def diff_since_sent(self):
+        """Changed fields per player since the last broadcast, and who left.
+
+        Advances ``sent`` to the current state, so call once per broadcast.
+        """
+        with self.lock:
+            changed = {}
+            for pid, record in self.players.items():
+                last = self.sent.get(pid)
+                fields = record.changed_fields(last)
+                if fields:
+                    changed[pid] = fields
+                    self.sent[pid] = dict(last or {}, **fields)
+            removed = [pid for pid in self.sent if pid not in self.players]
+            for pid in removed:
+                del self.sent[pid]
+            return changed, removed
+
+    def keyframe(self):
+        """Full state as of the last broadcast tick."""
+        with self.lock:
+            return {
+                'tick': self.sent_tick,
+                'players': {pid: dict(p, position=dict(p['position']))
+                            for pid, p in self.sent.items()}
+            }
+
+    def targets_in_range(self, user_id, radius):
+        """Other players within ``radius`` cells of ``user_id``, nearest first."""
+        with self.lock:
+            record = self.players[user_id]
+            return [pid for pid in self.grid.within(record.x, record.y, radius)
+                    if pid != user_id]
+
+    def snapshot(self, viewer=None):
+        """Copy of the players dict that is safe to serialize off-lock.
+
+        With a view radius set and a ``viewer`` given, only the players
+        that viewer can see are included.
+        """
+        with self.lock:
+            pids = self.players
+            if viewer is not None and self.view_radius and viewer in self.players:
+                pids = self.visible_from(viewer)
+            return {pid: self.players[pid].to_dict() for pid in pids}
+
+    def visible_from(self, user_id):
+        record = self.players[user_id]
+        return set(self.grid.within(record.x, record.y, self.view_radius))
+
+    def add_viewer(self, user_id, sid, codec):
+        with self.lock:
+            self.viewers[user_id] = (sid, codec)
+            self.visible.pop(user_id, None)
+
+    def remove_viewer(self, user_id, sid):
+        with self.lock:
+            if self.viewers.get(user_id, (None,))[0] == sid:
+                del self.viewers[user_id]
+                self.visible.pop(user_id, None)
+                self.viewer_tick.pop(user_id, None)
+                if user_id in self.players:
+                    self.players[user_id].seen = time.monotonic()
+
+    def mark_departed(self, user_id):
+        """Note a member whose socket closed without leaving the lobby."""
+        with self.lock:
+            if user_id not in self.players:
+                self.departed[user_id] = time.monotonic()
+
+    def stale_members(self, timeout):
+        """Members whose heartbeat was lost more than ``timeout`` seconds ago.
+
+        Returns ``(ghosts, departed)``: players still in ``players`` with no
+        socket in the lobby (seeded from the database, or their socket
+        left the rooms), and members who disconnected and never came back.
+        The departed are forgotten here; ghosts go through
+        ``remove_player_from_lobby``.
+        """
+        now = time.monotonic()
+        with self.lock:
+            ghosts = [pid for pid, p in self.players.items()
+                      if pid not in self.viewers and now - p.seen > timeout]
+            departed = [uid for uid, since in self.departed.items() if now - since > timeout]
+            for uid in departed:
+                del self.departed[uid]
+            return ghosts, departed
+
+    def memory_usage(self):
+        """Approximate bytes held by this lobby's state, by part."""
+        size = sys.getsizeof
+        with self.lock:
+            usage = {
+                'players': size(self.players) + sum(size(p) + size(p.username or '')
+                                                    for p in self.players.values()),
+                'grid': self.grid.nbytes(),
+                'sent': size(self.sent) + sum(size(d) + size(d.get('position', ()))
+                                              for d in self.sent.values()),
+                'projectiles': size(self.projectiles)
+                               + sum(size(p) for p in self.projectiles),
+                'views': size(self.viewers) + size(self.visible) + size(self.viewer_tick)
+                         + sum(size(v) for v in self.visible.values()),
+                'pending': size(self.pending_moves) + size(self.dirty) + size(self.departed),
+            }
+        with self.replay.lock:
+            usage['replay'] = len(self.replay.buffer) + sum(
+                len(data) for _, data in self.replay.sealed)
+        usage['total'] = sum(usage.values())
+        return usage
+
+    def resync(self, user_id):
+        """Send ``user_id`` a fresh keyframe of their view on the next tick."""
+        with self.lock:
+            self.visible.pop(user_id, None)
+
+    def audience(self, user_id):
+        """Sockets of the viewers that currently see ``user_id``."""
+        with self.lock:
+            return [sid for viewer, (sid, _) in self.viewers.items()
+                    if user_id in self.visible.get(viewer, ())]
+
+    def interest_updates(self, changed, keyframe):
+        """Per-viewer tick updates limited to players within ``view_radius``.
+
+        Call under ``lock`` right after ``diff_since_sent``. A viewer gets
+        full records for players entering its view, changed fields for
+        those still in it, and the ids that left it in ``removed``;
+        viewers with nothing new are skipped. Returns
+        ``[(sid, [(event, payload), ...]), ...]``.
+        """
+        updates = []
+        for uid, (sid, codec) in self.viewers.items():
+            if uid not in self.players:
+                continue
+            now_visible = self.visible_from(uid)
+            was_visible = self.visible.get(uid)
+            base = self.viewer_tick.get(uid, 0)
+            full = keyframe or was_visible is None
+            if full:
+                entered, left = now_visible, []
+                players = {pid: self.sent[pid] for pid in now_visible}
+            else:
+                entered = now_visible - was_visible
+                left = [pid for pid in was_visible if pid not in now_visible]
+                players = {pid: self.sent[pid] if pid in entered else changed[pid]
+                           for pid in now_visible if pid in entered or pid in changed}
+                if not (players or left):
+                    continue
+            self.visible[uid] = now_visible
+            self.viewer_tick[uid] = self.tick
+
+            if codec == 'binary':
+                events = []
+                meta = {pid: {'username': self.sent[pid]['username'],
+                              'avatar': self.sent[pid]['avatar']}
+                        for pid in players
+                        if pid in entered or 'username' in players[pid] or 'avatar' in players[pid]}
+                if meta:
+                    events.append(('player_meta', meta))
+                records = {pid: self.sent[pid] for pid in players}
+                frame = encode_state(FRAME_KEYFRAME if full else FRAME_DELTA,
+                                     self.tick, base, records, left)
+                events.append(('state_bin', frame))
+            elif full:
+                events = [('state_keyframe', {'tick': self.tick, 'players': players})]
+            else:
+                events = [('state_delta', {
+                    'tick': self.tick,
+                    'base': base,
+                    'players': players,
+                    'removed': left,
+                    'entered': list(entered)
+                })]
+            updates.append((sid, events))
+        return updates
+
+    def mark_dirty(self, user_ids):
+        with self.lock:
+            self.dirty.update(pid for pid in user_ids if pid in self.players)
+
+    def take_dirty_rows(self):
+        with self.lock:
+            rows = [self._db_row(pid, self.players[pid])
+                    for pid in self.dirty if pid in self.players]
+            self.dirty.clear()
+            return rows
+
+    @staticmethod
+    def _db_row(user_id, record):
+        row = {'id': user_id, 'pos_x': record.x, 'pos_y': record.y}
+        for field in PERSISTED_STATS:
+            row[field] = getattr(record, field)
+        return row
+
 
 game_state = {'lobbies': {}}
-attack_timestamps = {}
+_lobbies_lock = threading.Lock()
+_background_started = False
+
+
+def get_lobby_state(lobby_id, create=False):
+    lobby = game_state['lobbies'].get(lobby_id)
+    if lobby is None and create:
+        with _lobbies_lock:
+            lobby = game_state['lobbies'].setdefault(lobby_id, LobbyState(lobby_id))
+    elif lobby is not None and lobby.empty_since is not None:
+        # an empty lobby someone is about to join is not idle
+        lobby.empty_since = time.monotonic()
+    return lobby
+
+
+def persist_player_rows(rows):
+    """Write player rows back to the User table in a single transaction."""
+    if not rows:
+        return
+    db.session.execute(db.update(User), rows)
+    db.session.commit()
+    user_cache.update_rows(rows)
+
+
+def flush_lobby_state(lobby, reset_scores=False, achievements=()):
+    """Write a lobby's dirty players back to the database in one commit.
+
+    ``reset_scores`` zeroes kills and score for everyone in the lobby with
+    a single bulk UPDATE (a game was won), and ``achievements`` are
+    ``(user_id, rule)`` pairs inserted in the same transaction. Writes for
+    one lobby are serialized by ``flush_lock`` so an older snapshot can
+    never be committed over a newer one. If the commit fails, all of it is
+    kept on the lobby and retried by the next flush.
+    """
+    with lobby.flush_lock:
+        rows = lobby.take_dirty_rows()
+        reset_scores = reset_scores or lobby.pending_reset
+        achievements = lobby.pending_achievements + list(achievements)
+        lobby.pending_reset, lobby.pending_achievements = False, []
+        if not (rows or reset_scores or achievements):
+            return
+        try:
+            if reset_scores:
+                db.session.execute(
+                    db.update(User)
+                    .where(User.current_lobby == lobby.id)
+                    .values(kills=0, score=0)
+                )
+            if rows:
+                db.session.execute(db.update(User), rows)
+            if achievements:
+                db.session.add_all(unrecorded_achievements(achievements))
+            db.session.commit()
+            if reset_scores:
+                user_cache.update_lobby(lobby.id, kills=0, score=0)
+            user_cache.update_rows(rows)
+        except Exception:
+            db.session.rollback()
+            # keep everything for the next flush
+            lobby.mark_dirty(row['id'] for row in rows)
+            lobby.pending_reset = reset_scores
+            lobby.pending_achievements = achievements
+            raise
+
+
+def unrecorded_achievements(achievements):
+    """UserAchievement rows for the ``(user_id, rule)`` pairs not stored yet.
+
+    A pair already in the table (a retried flush, or a stale
+    ``unlocked_achievements`` entry) counts as earned and is skipped, so
+    the unique index on (user_id, achievement_id) never fails the commit.
+    """
+    pairs = {(user_id, rule.id) for user_id, rule in achievements}
+    stored = {tuple(r) for r in db.session.query(
+        UserAchievement.user_id, UserAchievement.achievement_id
+    ).filter(
+        UserAchievement.user_id.in_({user_id for user_id, _ in pairs}),
+        UserAchievement.achievement_id.in_({achievement_id for _, achievement_id in pairs})
+    )}
+    return [UserAchievement(user_id=user_id, achievement_id=achievement_id)
+            for user_id, achievement_id in sorted(pairs - stored)]
+
+
+def remove_player_from_lobby(lobby_id, user_id):
+    """Drop a player from a lobby's state, saving anything not yet flushed."""
+    unlocked_achievements.pop(user_id, None)
+    lobby = get_lobby_state(lobby_id)
+    if lobby is not None:
+        with lobby.flush_lock:
+            row = lobby.pop_player(user_id)
+            if row:
+                persist_player_rows([row])
+
+
+def emit_to_lobby(lobby, event, payload, about):
+    """Emit to the lobby room, or with a view radius only to the viewers
+    that can currently see player ``about``."""
+    if lobby.view_radius:
+        audience = lobby.audience(about)
+        for sid in audience:
+            socketio.emit(event, payload, to=sid)
+        recipients = len(audience)
+    else:
+        socketio.emit(event, payload, to=f'lobby_{lobby.id}')
+        recipients = sum(lobby.codecs.values())
+    metrics.observe('socketio_broadcast_recipients', recipients, FANOUT_BUCKETS, event=event)
+
+
+def settle_hits(lobby, results):
+    """Side effects of resolved hits: scores, wins and achievements.
+
+    Everything a batch of hits must make durable (a won game's reset, the
+    winner's stats, new achievements) goes out in one transaction; plain
+    damage is left to the periodic flush. Called without ``lobby.lock``
+    held, from a socket handler or the tick.
+    """
+    results = [r for r in results if r is not None]
+    if not results:
+        return
+    won = [r for r in results if r.won]
+    achievements = [(r.attacker_id, rule) for r in results for rule in r.unlocked]
+    if won:
+        publish_scores(lobby, lobby.players)
+    else:
+        publish_scores(lobby, {pid for r in results for pid in (r.attacker_id, r.target_id)})
+    if won or achievements:
+        try:
+            flush_lobby_state(lobby, reset_scores=bool(won), achievements=achievements)
+        except Exception:
+            # flush_lobby_state kept the writes; the periodic flush retries
+            logger.error(f"Hit flush failed for lobby {lobby.id}\n{traceback.format_exc()}")
+    for r in won:
+        winner = lobby.players.get(r.attacker_id)
+        socketio.emit('game_won', {'winner': winner.username if winner else None},
+                      to=f'lobby_{lobby.id}')
+    for r in results:
+        announce_achievements(lobby.id, r.unlocked)
+
+
+def run_tick(lobby):
+    """Advance one lobby by a tick and broadcast the resulting changes.
+
+    All moves queued since the previous tick are applied together and
+    projectiles are stepped, with their hits resolved as one batch; then a
+    single ``state_delta`` (changed fields only) is sent to the lobby's
+    JSON clients and a ``state_bin`` frame to its binary ones, followed by
+    ``projectile_impacts`` for shots that stopped. With a view radius each
+    viewer instead gets its own update covering only what it can see.
+    Every ``KEYFRAME_INTERVAL`` ticks, or when forced, a full
+    ``state_keyframe`` is sent instead so clients can resynchronise.
+    """
+    hits = []
+    with lobby.lock:
+        lobby.apply_pending_moves()
+        stopped = lobby.step_projectiles()
+        if stopped:
+            damage = app.config['RANGED_DAMAGE']
+            with app.app_context():
+                hits = [lobby.apply_hit(p.owner, target, damage)
+                        for p, target in stopped if target is not None]
+        lobby.tick += 1
+        changed, removed = lobby.diff_since_sent()
+        if lobby.tick % app.config['REPLAY_SNAPSHOT_INTERVAL'] == 0:
+            lobby.replay.snapshot(lobby.tick, lobby.players)
+        else:
+            lobby.replay.state(lobby.tick, {pid: lobby.players[pid] for pid in changed})
+        keyframe = lobby.force_keyframe or \
+            lobby.tick % app.config['KEYFRAME_INTERVAL'] == 0
+        event = frame = None
+        updates = []
+        if lobby.view_radius:
+            base, lobby.sent_tick = lobby.sent_tick, lobby.tick
+            lobby.force_keyframe = False
+            updates = lobby.interest_updates(changed, keyframe)
+        elif (changed or removed or keyframe) and (lobby.players or removed):
+            base, lobby.sent_tick = lobby.sent_tick, lobby.tick
+            lobby.force_keyframe = False
+            if lobby.codecs['json']:
+                if keyframe:
+                    event, payload = 'state_keyframe', lobby.keyframe()
+                else:
+                    event, payload = 'state_delta', {
+                        'tick': lobby.tick,
+                        'base': base,
+                        'players': changed,
+                        'removed': removed
+                    }
+            if lobby.codecs['binary']:
+                meta = {pid: {'username': lobby.sent[pid]['username'],
+                              'avatar': lobby.sent[pid]['avatar']}
+                        for pid, fields in changed.items()
+                        if 'username' in fields or 'avatar' in fields}
+                if keyframe:
+                    frame = encode_state(FRAME_KEYFRAME, lobby.tick, base, lobby.sent, [])
+                else:
+                    frame = encode_state(FRAME_DELTA, lobby.tick, base,
+                                         {pid: lobby.sent[pid] for pid in changed}, removed)
+    if event:
+        socketio.emit(event, payload, to=state_room(lobby.id, 'json'))
+        metrics.observe('socketio_broadcast_recipients', lobby.codecs['json'],
+                        FANOUT_BUCKETS, event=event)
+    if frame:
+        if meta:
+            socketio.emit('player_meta', meta, to=state_room(lobby.id, 'binary'))
+        socketio.emit('state_bin', frame, to=state_room(lobby.id, 'binary'))
+        metrics.observe('socketio_broadcast_recipients', lobby.codecs['binary'],
+                        FANOUT_BUCKETS, event='state_bin')
+    for sid, events in updates:
+        for name, data in events:
+            socketio.emit(name, data, to=sid)
+    if updates:
+        metrics.observe('socketio_broadcast_recipients', len(updates),
+                        FANOUT_BUCKETS, event='interest_update')
+    if stopped:
+        # flight itself isn't broadcast: clients animate it from
+        # attack_launched and only learn where each shot ended
+        socketio.emit('projectile_impacts', {
+            'tick': lobby.tick,
+            'impacts': [{'id': p.id, 'position': {'x': p.x, 'y': p.y}, 'target_id': target}
+                        for p, target in stopped]
+        }, to=f'lobby_{lobby.id}')
+        with app.app_context():
+            settle_hits(lobby, hits)
+
+
+def tick_loop():
+    """Background task: run each lobby's tick at its own fixed rate."""
+    while True:
+        now = time.monotonic()
+        wake = now + 0.1
+        for lobby in list(game_state['lobbies'].values()):
+            if now >= lobby.next_tick:
+                try:
+                    run_tick(lobby)
+                except Exception:
+                    logger.error(f"Tick failed for lobby {lobby.id}\n{traceback.format_exc()}")
+                interval = 1.0 / lobby.tick_rate
+                # don't try to catch up on ticks missed while overloaded
+                lobby.next_tick = max(lobby.next_tick + interval, now)
+            wake = min(wake, lobby.next_tick)
+        socketio.sleep(max(wake - time.monotonic(), 0.001))
+
+
+def state_flush_loop():
+    """Background task: periodically write dirty player state to the DB."""
+    while True:
+        socketio.sleep(app.config['STATE_FLUSH_INTERVAL'])
+        with app.app_context():
+            for lobby in list(game_state['lobbies'].values()):
+                try:
+                    flush_lobby_state(lobby)
+                except Exception:
+                    db.session.rollback()
+                    logger.error(f"State flush failed for lobby {lobby.id}\n{traceback.format_exc()}")
+
+
+# ─── LOBBY LIFECYCLE ───────────────────────────────────────────────────────────
+
+def reap_members(lobby):
+    """Drop members whose heartbeat was lost and clear their current_lobby."""
+    ghosts, departed = lobby.stale_members(app.config['PLAYER_HEARTBEAT_TIMEOUT'])
+    if not (ghosts or departed):
+        return
+    for user_id in ghosts:
+        remove_player_from_lobby(lobby.id, user_id)
+        socketio.emit('player_left', {'player_id': user_id}, to=f'lobby_{lobby.id}')
+    user_ids = ghosts + departed
+    cleared = db.session.execute(
+        db.update(User)
+        .where(User.id.in_(user_ids), User.current_lobby == lobby.id)
+        .values(current_lobby=None)
+    ).rowcount
+    if cleared:
+        lobby_directory.adjust(lobby.id, -cleared)
+    db.session.commit()
+    for user_id in user_ids:
+        user_cache.update(user_id, current_lobby=None)
+    logger.info(f"Lobby {lobby.id}: reaped {len(ghosts)} without a socket, "
+                f"{len(departed)} disconnected")
+
+
+def reap_idle_lobby(lobby):
+    """Forget an in-memory lobby that has been empty for LOBBY_IDLE_TTL.
+
+    Returns whether it was removed. Its replay buffer is written out and
+    any unsaved rows flushed; the Lobby row itself is left alone.
+    """
+    with _lobbies_lock, lobby.lock:
+        if (lobby.players or lobby.viewers or lobby.departed or lobby.empty_since is None
+                or time.monotonic() - lobby.empty_since < app.config['LOBBY_IDLE_TTL']):
+            return False
+        if game_state['lobbies'].get(lobby.id) is lobby:
+            del game_state['lobbies'][lobby.id]
+    flush_lobby_state(lobby)
+    chunks = lobby.replay.drain()
+    if chunks:
+        run_blocking(write_replay_chunks, chunks)
+    return True
+
+
+def reap_lobby_rows():
+    """Delete Lobby rows that have had no members for LOBBY_ROW_TTL.
+
+    Only lobbies this worker owns are considered, and the DELETE itself
+    re-checks that no user points at the lobby, so a concurrent join can
+    never be left referring to a deleted row.
+    """
+    ttl = app.config['LOBBY_ROW_TTL']
+    if not ttl:
+        return
+    ids = [lobby_id for lobby_id in lobby_directory.idle(ttl)
+           if owns_lobby(lobby_id) and lobby_id not in game_state['lobbies']]
+    if not ids:
+        return
+    db.session.execute(
+        db.delete(Lobby)
+        .where(Lobby.id.in_(ids), ~db.exists().where(User.current_lobby == Lobby.id))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    remaining = {lobby_id for (lobby_id,) in
+                 db.session.query(Lobby.id).filter(Lobby.id.in_(ids))}
+    for lobby_id in ids:
+        if lobby_id not in remaining:
+            lobby_directory.remove(lobby_id)
+    if len(remaining) < len(ids):
+        logger.info(f"Deleted {len(ids) - len(remaining)} idle lobby rows")
+
+
+def lobby_reaper_loop():
+    """Background task: drop lost members, idle lobby state, idle lobby rows and old replays."""
+    while True:
+        socketio.sleep(app.config['LOBBY_REAP_INTERVAL'])
+        with app.app_context():
+            reaped = 0
+            for lobby in list(game_state['lobbies'].values()):
+                try:
+                    reap_members(lobby)
+                    reaped += reap_idle_lobby(lobby)
+                except Exception:
+                    db.session.rollback()
+                    logger.error(f"Reaping lobby {lobby.id} failed\n{traceback.format_exc()}")
+            if reaped:
+                logger.info(f"Reaped {reaped} idle lobbies from memory")
+            try:
+                reap_lobby_rows()
+            except Exception:
+                db.session.rollback()
+                logger.error(f"Reaping lobby rows failed\n{traceback.format_exc()}")
+            if app.config['REPLAY_DIR']:
+                recording = set()
+                for lobby in list(game_state['lobbies'].values()):
+                    recording.add(lobby.replay.path)
+                    recording.update(path for path, _ in list(lobby.replay.sealed))
+                try:
+                    pruned = run_blocking(prune_replays, recording)
+                except OSError:
+                    logger.error(f"Pruning replays failed\n{traceback.format_exc()}")
+                else:
+                    replay_stats['pruned'] += pruned
+                    if pruned:
+                        logger.info(f"Pruned {pruned} old replay files")
+
+
+def lobby_memory():
+    """Approximate memory of every in-memory lobby, and the total."""
+    lobbies = {lobby.id: lobby.memory_usage() for lobby in list(game_state['lobbies'].values())}
+    total = Counter()
+    for usage in lobbies.values():
+        total.update(usage)
+    return {'lobbies': lobbies, 'total': dict(total), 'count': len(lobbies)}
+
+
+# ─── MATCHMAKING ───────────────────────────────────────────────────────────────
+
+QueueEntry = namedtuple('QueueEntry', 'sid user_id skill queued_at')
+
+
+def player_skill(stats):
+    """Matchmaking skill of a User row or PlayerRecord."""
+    return stats.lifetime_score + stats.wins * app.config['MATCHMAKING_WIN_WEIGHT']
+
+
+class Matchmaker:
+    """Queue of players waiting for a match, placed in batches.
+
+    Every MATCHMAKING_INTERVAL ``run_batch`` takes the whole queue, sorted
+    by skill, and seats each player in the fullest open lobby of their
+    skill bracket (the mean skill of its players in memory; an empty lobby
+    fits anyone). A player's bracket tolerance widens by one for every
+    MATCHMAKING_WIDEN_AFTER seconds they have waited. Players left over
+    get new lobbies, grouped by bracket.
+
+    Seats are taken with ``lobby_directory.reserve(hold=True)``, the same
+    atomic check joins use, so batches and hand-picked joins can't
+    overfill a lobby between them. A placed player is sent
+    ``match_found`` and their seat waits MATCHMAKING_SEAT_TTL seconds for
+    the ``join_lobby`` that claims it.
+    """
+
+    def __init__(self):
+        self.queue = {}  # user id -> QueueEntry
+        self.seats = {}  # user id -> (lobby id, monotonic expiry)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def enqueue(self, sid, user_id, skill):
+        """Queue a player (again); returns their position in the queue."""
+        with self.lock:
+            previous = self.queue.pop(user_id, None)
+            queued_at = previous.queued_at if previous else time.monotonic()
+            self.queue[user_id] = QueueEntry(sid, user_id, skill, queued_at)
+            self.counts['queued'] += previous is None
+            return len(self.queue)
+
+    def cancel(self, user_id):
+        with self.lock:
+            removed = self.queue.pop(user_id, None) is not None
+            self.counts['cancelled'] += removed
+            return removed
+
+    def claim(self, user_id, lobby_id):
+        """Take the seat held for ``user_id`` if it is in ``lobby_id``.
+
+        A seat held in another lobby is given back, since the player chose
+        a different one.
+        """
+        with self.lock:
+            self.queue.pop(user_id, None)
+            seat = self.seats.pop(user_id, None)
+        if seat is None:
+            return False
+        if seat[0] == lobby_id:
+            return lobby_directory.claim(lobby_id)
+        lobby_directory.release(seat[0])
+        return False
+
+    def lobby_bracket(self, lobby_id):
+        # not get_lobby_state: looking must not keep an empty lobby alive
+        lobby = game_state['lobbies'].get(lobby_id)
+        if lobby is None:
+            return None
+        with lobby.lock:
+            if not lobby.players:
+                return None
+            skill = sum(player_skill(p) for p in lobby.players.values()) / len(lobby.players)
+        return int(skill // app.config['MATCHMAKING_SKILL_BAND'])
+
+    def run_batch(self):
+        """Place everyone queued; returns ``[(entry, lobby id), ...]``."""
+        now = time.monotonic()
+        self.expire_seats(now)
+        with self.lock:
+            waiting, self.queue = list(self.queue.values()), {}
+        if not waiting:
+            return []
+        band = app.config['MATCHMAKING_SKILL_BAND']
+        open_lobbies = [s for s in lobby_directory.all()
+                        if owns_lobby(s['id']) and s['player_count'] < s['max_players']]
+        brackets = {s['id']: self.lobby_bracket(s['id']) for s in open_lobbies}
+        # fill the fullest lobbies first so games start sooner
+        open_lobbies.sort(key=lambda s: s['max_players'] - s['player_count'])
+
+        placed, leftover = [], []
+        for entry in sorted(waiting, key=lambda e: e.skill):
+            bracket = int(entry.skill // band)
+            tolerance = int((now - entry.queued_at) // app.config['MATCHMAKING_WIDEN_AFTER'])
+            for summary in open_lobbies:
+                lobby_bracket = brackets[summary['id']]
+                if lobby_bracket is not None and abs(lobby_bracket - bracket) > tolerance:
+                    continue
+                if lobby_directory.reserve(summary['id'], hold=True):
+                    brackets[summary['id']] = bracket if lobby_bracket is None else lobby_bracket
+                    placed.append((entry, summary['id']))
+                    break
+            else:
+                leftover.append(entry)
+
+        size = app.config['MATCHMAKING_LOBBY_SIZE']
+        groups = {}
+        for entry in leftover:
+            groups.setdefault(int(entry.skill // band), []).append(entry)
+        for bracket, entries in sorted(groups.items()):
+            for start in range(0, len(entries), size):
+                lobby = Lobby(name=f"Match (skill {bracket * band}+)", max_players=size)
+                db.session.add(lobby)
+                db.session.commit()
+                lobby_directory.add(lobby)
+                self.counts['lobbies_created'] += 1
+                for entry in entries[start:start + size]:
+                    # another worker's lobby is seated when its owner handles the join
+                    if not owns_lobby(lobby.id) or lobby_directory.reserve(lobby.id, hold=True):
+                        placed.append((entry, lobby.id))
+                    else:
+                        self.enqueue(entry.sid, entry.user_id, entry.skill)
+
+        expires = now + app.config['MATCHMAKING_SEAT_TTL']
+        with self.lock:
+            for entry, lobby_id in placed:
+                if owns_lobby(lobby_id):
+                    self.seats[entry.user_id] = (lobby_id, expires)
+            self.counts['placed'] += len(placed)
+            if placed:
+                self.counts['batches'] += 1
+        return placed
+
+    def expire_seats(self, now):
+        with self.lock:
+            expired = [(uid, lobby_id) for uid, (lobby_id, expires) in self.seats.items()
+                       if now >= expires]
+            for uid, _ in expired:
+                del self.seats[uid]
+            self.counts['seats_expired'] += len(expired)
+        for _, lobby_id in expired:
+            lobby_directory.release(lobby_id)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, waiting=len(self.queue), seats_held=len(self.seats))
+
+
+matchmaker = Matchmaker()
+
+
+def matchmaking_loop():
+    """Background task: place queued players every MATCHMAKING_INTERVAL."""
+    while True:
+        socketio.sleep(app.config['MATCHMAKING_INTERVAL'])
+        with app.app_context():
+            try:
+                placed = matchmaker.run_batch()
+            except Exception:
+                db.session.rollback()
+                logger.error(f"Matchmaking batch failed\n{traceback.format_exc()}")
+                continue
+        for entry, lobby_id in placed:
+            socketio.emit('match_found', {'lobby_id': lobby_id}, to=entry.sid)
+
+
+def ensure_background_tasks():
+    global _background_started
+    with _lobbies_lock:
+        if _background_started:
+            return
+        _background_started = True
+    socketio.start_background_task(state_flush_loop)
+    socketio.start_background_task(tick_loop)
+    socketio.start_background_task(lobby_reaper_loop)
+    socketio.start_background_task(matchmaking_loop)
+    if app.config['REPLAY_DIR']:
+        socketio.start_background_task(replay_flush_loop)
+
+
+# ─── ACHIEVEMENTS ──────────────────────────────────────────────────────────────
+
+AchievementRule = namedtuple(
+    'AchievementRule', 'id name description icon stat threshold'
+)
+
+
+class AchievementRegistry:
+    """The Achievement table compiled into threshold rules, grouped by stat.
+
+    A requirement such as ``kills_10`` becomes "``kills`` >= 10". Rules are
+    loaded once on first use; call ``load`` again after editing the table.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self.by_stat = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        rules = []
+        for a in Achievement.query.all():
+            stat, _, threshold = a.requirement.rpartition('_')
+            if stat not in PERSISTED_STATS or not threshold.isdigit():
+                logger.warning(f"Ignoring achievement {a.id} with unknown requirement {a.requirement!r}")
+                continue
+            rules.append(AchievementRule(a.id, a.name, a.description, a.icon, stat, int(threshold)))
+        by_stat = {}
+        for rule in sorted(rules, key=lambda r: r.threshold):
+            by_stat.setdefault(rule.stat, []).append(rule)
+        self.rules, self.by_stat = rules, by_stat
+        self._loaded = True
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load()
+
+    def earned(self, stats, changed, unlocked):
+        """Rules on the ``changed`` stats that the ``stats`` record meets and aren't unlocked."""
+        self.ensure_loaded()
+        earned = []
+        for stat in changed:
+            for rule in self.by_stat.get(stat, ()):
+                if getattr(stats, stat) < rule.threshold:
+                    break
+                if rule.id not in unlocked:
+                    earned.append(rule)
+        return earned
+
+
+achievement_registry = AchievementRegistry()
+# user id -> ids of achievements already unlocked, for players in a lobby
+unlocked_achievements = {}
+
+
+def load_unlocked_achievements(*user_ids):
+    """Cache the unlocked achievement ids of players entering a lobby.
+
+    Called before they are added and without the lobby's lock, so the
+    query never holds up the lobby's tick.
+    """
+    if not user_ids:
+        return
+    unlocked = {user_id: set() for user_id in user_ids}
+    rows = db.session.query(UserAchievement.user_id, UserAchievement.achievement_id).filter(
+        UserAchievement.user_id.in_(user_ids))
+    for user_id, achievement_id in rows:
+        unlocked[user_id].add(achievement_id)
+    unlocked_achievements.update(unlocked)
+
+
+def check_achievements(user_id, stats, changed):
+    """Return the achievements ``stats`` now qualifies the user for.
+
+    Only rules on the ``changed`` stats are evaluated, against the cached
+    set of already-unlocked ids; the returned rules are marked unlocked.
+    Runs under the lobby's lock, so it never queries: a player without a
+    cached set is skipped, and the rules are checked again on the stat's
+    next change.
+    """
+    unlocked = unlocked_achievements.get(user_id)
+    if unlocked is None:
+        return []
+    earned = achievement_registry.earned(stats, changed, unlocked)
+    unlocked.update(rule.id for rule in earned)
+    return earned
+
+
+def announce_achievements(lobby_id, rules):
+    """Tell the lobby about achievements saved by ``flush_lobby_state``."""
+    for rule in rules:
+        socketio.emit('achievement_unlocked', {
+            'name': rule.name,
+            'description': rule.description,
+            'icon': rule.icon
+        }, to=f'lobby_{lobby_id}')
+
+
+def redirect_to_owner(lobby_id):
+    emit('lobby_redirect', {
+        'lobby_id': lobby_id,
+        'url': app.config['WORKER_URLS'][lobby_owner(lobby_id)]
+    })
+
+
+# ─── INPUT RATE LIMITING ───────────────────────────────────────────────────────
+
+class InputLimiter:
+    """Token buckets per key (a socket session, a username, an IP) and event type.
+
+    Each limited event refills at ``rate`` tokens per second up to
+    ``burst``; an event arriving at an empty bucket is dropped before its
+    handler runs. ``counts`` tallies (event, outcome) for /stats/input.
+    Keys nobody discards (usernames, IPs) are pruned once their buckets
+    have refilled, whenever more than ``max_keys`` are held.
+    """
+
+    def __init__(self, limits, max_keys=10000):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> {event: [tokens, last refill]}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def allow(self, key, event):
+        limit = self.limits.get(event)
+        with self.lock:
+            if limit is None:
+                self.counts[event, 'accepted'] += 1
+                return True
+            rate, burst = limit
+            now = time.monotonic()
+            if key not in self.buckets and len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self.buckets.setdefault(key, {}).setdefault(event, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.counts[event, 'dropped'] += 1
+                return False
+            bucket[0] -= 1
+            self.counts[event, 'accepted'] += 1
+            return True
+
+    def count(self, event, outcome):
+        with self.lock:
+            self.counts[event, outcome] += 1
+
+    def _prune(self, now):
+        def refilled(event, bucket):
+            rate, burst = self.limits[event]
+            return bucket[0] + (now - bucket[1]) * rate >= burst
+        for key in [key for key, events in self.buckets.items()
+                    if all(refilled(e, b) for e, b in events.items())]:
+            del self.buckets[key]
+
+    def discard(self, sid):
+        with self.lock:
+            self.buckets.pop(sid, None)
+
+    def stats(self):
+        with self.lock:
+            events = {}
+            for (event, outcome), n in self.counts.items():
+                events.setdefault(event, {})[outcome] = n
+            return {'events': events, 'sessions': len(self.buckets)}
+
+
+input_limiter = InputLimiter(app.config['INPUT_RATE_LIMITS'])
+# register/login attempts, keyed by client IP and by username
+auth_limiter = InputLimiter(app.config['AUTH_RATE_LIMITS'])
+
+
+def auth_allowed(username):
+    """Spend one register/login attempt from the client IP, then the username.
+
+    The username's bucket is only spent once the IP's allowed the attempt,
+    so a throttled client can't keep someone else's account locked out.
+    """
+    return (auth_limiter.allow(request.remote_addr, 'ip')
+            and auth_limiter.allow(str(username), 'username'))
+
+
+def rate_limited(event):
+    """Drop a socket event when the sender's bucket for ``event`` is empty."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            if not input_limiter.allow(request.sid, event):
+                return None
+            return handler(*args)
+        return wrapper
+    return decorator
+
+
+def attack_ready(lobby, user_id, attack_type):
+    """Enforce ATTACK_COOLDOWNS per player; records the attack if allowed."""
+    now = time.monotonic()
+    with lobby.lock:
+        record = lobby.players.get(user_id)
+        if record is None:
+            return False
+        previous = getattr(record, f'{attack_type}_at')
+        if previous is not None and now - previous < app.config['ATTACK_COOLDOWNS'][attack_type]:
+            input_limiter.count('attack', 'cooldown')
+            return False
+        setattr(record, f'{attack_type}_at', now)
+        return True
+
+
+# ─── WIRE CODEC ────────────────────────────────────────────────────────────────
+#
+# Clients pick a codec for tick updates when they connect
+# (``io({auth: {codec: 'binary'}})``); JSON is the default. Binary clients
+# get player metadata (username, avatar) as JSON once, in player_joined or
+# player_meta, and after that each tick as a ``state_bin`` frame: a header
+# followed by one fixed-width record per changed player and the ids that
+# left. Other events stay JSON for everyone.
+
+STATE_CODECS = ('json', 'binary')
+FRAME_DELTA, FRAME_KEYFRAME = 1, 2
+# kind, tick, base tick, player records, removed ids
+STATE_HEADER = struct.Struct('<BIIHH')
+# id, x, y, health, lifetime_score, kills, deaths, wins
+PLAYER_RECORD = struct.Struct('<IhhhIHII')
+
+# sid -> {'codec': ..., 'lobby': id of the lobby whose rooms it is in}
+socket_sessions = {}
+
+
+def state_room(lobby_id, codec):
+    return f'lobby_{lobby_id}_{codec}'
+
+
+def encode_state(kind, tick, base, players, removed):
+    """Pack a tick update for binary clients; ``players`` maps id -> record."""
+    frame = bytearray(STATE_HEADER.size + PLAYER_RECORD.size * len(players)
+                      + 4 * len(removed))
+    STATE_HEADER.pack_into(frame, 0, kind, tick, base, len(players), len(removed))
+    offset = STATE_HEADER.size
+    for pid, p in players.items():
+        pos = p['position']
+        PLAYER_RECORD.pack_into(frame, offset, pid, pos['x'], pos['y'], p['health'],
+                                p['lifetime_score'], p['kills'], p['deaths'], p['wins'])
+        offset += PLAYER_RECORD.size
+    struct.pack_into(f'<{len(removed)}I', frame, offset, *removed)
+    return bytes(frame)
+
+
+def enter_lobby_rooms(lobby):
+    """Join the lobby's event room and the state room for this socket's codec."""
+    session = socket_sessions.setdefault(request.sid, {'codec': 'json', 'lobby': None})
+    if session['lobby'] != lobby.id:
+        exit_lobby_rooms()
+        session['lobby'] = lobby.id
+        with lobby.lock:
+            lobby.codecs[session['codec']] += 1
+    lobby.add_viewer(current_user.id, request.sid, session['codec'])
+    join_room(f'lobby_{lobby.id}')
+    join_room(state_room(lobby.id, session['codec']))
+
+
+def exit_lobby_rooms():
+    session = socket_sessions.get(request.sid)
+    if not session or session['lobby'] is None:
+        return
+    lobby_id, session['lobby'] = session['lobby'], None
+    leave_room(f'lobby_{lobby_id}')
+    leave_room(state_room(lobby_id, session['codec']))
+    lobby = get_lobby_state(lobby_id)
+    if lobby is not None:
+        with lobby.lock:
+            lobby.codecs[session['codec']] -= 1
+        if current_user.is_authenticated:
+            lobby.remove_viewer(current_user.id, request.sid)
+
+
+@metrics.collector
+def collect_state_metrics():
+    """Gauges and counters that are kept elsewhere, read at scrape time."""
+    lobbies = list(game_state['lobbies'].values())
+    with http_latency_lock:
+        latency = [({'route': rule}, h.to_dict()) for rule, h in http_latency.items()]
+    with input_limiter.lock:
+        inputs = [({'event': event, 'outcome': outcome}, n)
+                  for (event, outcome), n in input_limiter.counts.items()]
+    with auth_limiter.lock:
+        auth = [({'key': key, 'outcome': outcome}, n)
+                for (key, outcome), n in auth_limiter.counts.items()]
+    hasher = password_hasher.stats()
+    memory = lobby_memory()
+    matchmaking = matchmaker.stats()
+    cache = user_cache.stats()
+    return [
+        ('http_request_duration_seconds', 'histogram', 'HTTP request latency, by route', latency),
+        ('socketio_input_events_total', 'counter',
+         'Rate-limited socket input, by event and outcome', inputs),
+        ('socketio_connections', 'gauge', 'Open Socket.IO connections',
+         [({}, len(socket_sessions))]),
+        ('game_lobbies_active', 'gauge', 'Lobbies with players in memory',
+         [({}, sum(1 for lobby in lobbies if lobby.players))]),
+        ('game_players', 'gauge', 'Players in in-memory lobbies',
+         [({}, sum(len(lobby.players) for lobby in lobbies))]),
+        ('game_projectiles', 'gauge', 'Projectiles in flight',
+         [({}, sum(len(lobby.projectiles) for lobby in lobbies))]),
+        ('game_lobbies_in_memory', 'gauge', 'Lobbies with state held in memory',
+         [({}, memory['count'])]),
+        ('matchmaking_waiting', 'gauge', 'Players queued for matchmaking',
+         [({}, matchmaking['waiting'])]),
+        ('matchmaking_seats_held', 'gauge', 'Seats held for placed players who have not joined',
+         [({}, matchmaking['seats_held'])]),
+        ('matchmaking_placed_total', 'counter', 'Players placed in a lobby by matchmaking',
+         [({}, matchmaking.get('placed', 0))]),
+        ('game_state_bytes', 'gauge', 'Approximate memory of in-memory lobby state, by part',
+         [({'part': part}, n) for part, n in memory['total'].items() if part != 'total']),
+        ('log_queue_depth', 'gauge', 'Log records waiting to be written',
+         [({}, log_queue.qsize())]),
+        ('log_records_dropped_total', 'counter', 'Log records dropped under backpressure',
+         [({}, queue_handler.dropped)]),
+        ('auth_attempts_total', 'counter',
+         'Register/login attempts, by throttle key and outcome', auth),
+        ('password_hash_pending', 'gauge', 'Password hashes queued or running',
+         [({}, hasher['pending'])]),
+        ('password_hash_rejected_total', 'counter',
+         'Password hashes refused because the queue was full',
+         [({}, hasher['rejected'])]),
+        ('replay_bytes_written_total', 'counter', 'Match replay bytes appended to disk',
+         [({}, replay_stats['bytes'])]),
+        ('replay_write_errors_total', 'counter', 'Failed match replay writes',
+         [({}, replay_stats['errors'])]),
+        ('replay_files_pruned_total', 'counter', 'Match replay files deleted by retention',
+         [({}, replay_stats['pruned'])]),
+        ('user_cache_entries', 'gauge', 'Users in the identity cache',
+         [({}, cache['entries'])]),
+        ('user_cache_lookups_total', 'counter', 'Identity cache lookups, by result',
+         [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])]),
+    ]
+
+
+# ─── SOCKET.IO EVENTS ──────────────────────────────────────────────────────────
 
 @socketio.on('connect')
-def handle_connect():
+@instrumented('connect')
+def handle_connect(auth=None):
+    codec = auth.get('codec') if isinstance(auth, dict) else None
+    socket_sessions[request.sid] = {
+        'codec': codec if codec in STATE_CODECS else 'json',
+        'lobby': None
+    }
     if not current_user.is_authenticated:
         return
+    # keep this user's row cached for as long as the socket is open
+    user_cache.pin(current_user.id)
+    socket_sessions[request.sid]['user_id'] = current_user.id
+    ensure_background_tasks()
     logger.info(f"Socket CONNECT username={current_user.username}")
-    if current_user.current_lobby:
+    # a lobby held by another worker is only re-entered through join_lobby
+    if current_user.current_lobby and owns_lobby(current_user.current_lobby):
         room = f"lobby_{current_user.current_lobby}"
-        join_room(room)
-        if current_user.current_lobby not in game_state['lobbies']:
-            game_state['lobbies'][current_user.current_lobby] = {'players': {}}
-        game_state['lobbies'][current_user.current_lobby]['players'][current_user.id] = {
-            'username': current_user.username,
-            'avatar': current_user.avatar,
-            'position': json.loads(current_user.position),
-            'health': current_user.health,
-            'lifetime_score': current_user.lifetime_score,
-            'wins': current_user.wins
-        }
+        lobby = get_lobby_state(current_user.current_lobby, create=True)
+        enter_lobby_rooms(lobby)
+        load_unlocked_achievements(current_user.id)
+        lobby.add_player(current_user)
+        lobby.force_keyframe = True
+        # with a view radius the others learn about the newcomer on the tick
         emit('player_joined', {
-            'players': game_state['lobbies'][current_user.current_lobby]['players'],
-            'current_user_id': current_user.id
-        }, room=room)
+            'players': lobby.snapshot(viewer=current_user.id),
+            'current_user_id': current_user.id,
+            'grid': {'width': lobby.grid.width, 'height': lobby.grid.height}
+        }, room=None if lobby.view_radius else room)
 
 @socketio.on('disconnect')
+@instrumented('disconnect')
 def handle_disconnect():
+    input_limiter.discard(request.sid)
+    exit_lobby_rooms()
+    socket = socket_sessions.pop(request.sid, None)
+    if socket and socket.get('user_id'):
+        user_cache.unpin(socket['user_id'])
+        matchmaker.cancel(socket['user_id'])
     if not current_user.is_authenticated or not current_user.current_lobby:
         return
     room = f"lobby_{current_user.current_lobby}"
     logger.info(f"Socket DISCONNECT username={current_user.username} room={room}")
-    leave_room(room)
-    lobby = game_state['lobbies'].get(current_user.current_lobby, {})
-    lobby.get('players', {}).pop(current_user.id, None)
+    remove_player_from_lobby(current_user.current_lobby, current_user.id)
+    lobby = get_lobby_state(current_user.current_lobby)
+    if lobby is not None:
+        # current_lobby is kept so a reconnect resumes; the reaper clears
+        # it if they don't come back within PLAYER_HEARTBEAT_TIMEOUT
+        lobby.mark_departed(current_user.id)
     emit('player_left', {'player_id': current_user.id}, room=room)
 
 @socketio.on('join_lobby')
+@instrumented('join_lobby')
 def handle_join_lobby(data):
     if not current_user.is_authenticated:
         logging.warning('Socket join_lobby: user not authenticated')
         emit('join_error', {'error': 'Not authenticated'})
         return
     
-    lobby_id = data.get('lobby_id')
+    try:
+        lobby_id = int(data.get('lobby_id'))
+    except (TypeError, ValueError):
+        emit('join_error', {'error': 'Lobby not found'})
+        return
     logging.info(f"Join attempt by {current_user.username} (ID: {current_user.id}) to lobby {lobby_id}")
     
-    lobby = Lobby.query.get(lobby_id)
+    lobby = lobby_directory.get(lobby_id)
     if not lobby:
         logging.warning(f'Socket join_lobby: lobby {lobby_id} not found')
         emit('join_error', {'error': 'Lobby not found'})
         return
     
-    if len(lobby.players) >= lobby.max_players:
+    if not owns_lobby(lobby_id):
+        # another worker holds this lobby's state; the client reconnects there
+        redirect_to_owner(lobby_id)
+        return
+    
+    previous_lobby = current_user.current_lobby
+    # a seat the matchmaker held for this player, or a free one taken now
+    seated = matchmaker.claim(current_user.id, lobby_id)
+    reserved = previous_lobby != lobby_id and not seated
+    if reserved and not lobby_directory.reserve(lobby_id):
         logging.info(f'Socket join_lobby: lobby {lobby_id} full')
         emit('join_error', {'error': 'Lobby is full'})
         return
     
     if current_user.current_lobby:
         logging.info(f"Player {current_user.username} leaving lobby {current_user.current_lobby}")
-        leave_room(f'lobby_{current_user.current_lobby}')
-        if current_user.current_lobby in game_state['lobbies']:
-            if current_user.id in game_state['lobbies'][current_user.current_lobby]['players']:
-                del game_state['lobbies'][current_user.current_lobby]['players'][current_user.id]
-                logging.info(f"Removed player from old lobby state")
+        exit_lobby_rooms()
+        remove_player_from_lobby(current_user.current_lobby, current_user.id)
+        logging.info(f"Removed player from old lobby state")
     
+    # Seed a cold lobby from the database once; after that the in-memory
+    # state is authoritative and only the joining player is added.
+    state = get_lobby_state(lobby_id)
+    if state is None:
+        state = get_lobby_state(lobby_id, create=True)
+        members = User.query.filter_by(current_lobby=lobby_id).all()
+        load_unlocked_achievements(*(user.id for user in members))
+        for user in members:
+            state.add_player(user)
+
+    # seats given back before the commit (see LobbyDirectory)
+    if previous_lobby and previous_lobby != lobby_id:
+        lobby_directory.adjust(previous_lobby, -1)
+    elif previous_lobby == lobby_id and seated:
+        # already counted as a member; give back the seat held for them
+        lobby_directory.adjust(lobby_id, -1)
     current_user.current_lobby = lobby_id
     db.session.commit()
-    join_room(f'lobby_{lobby_id}')
-    
-    if lobby_id not in game_state['lobbies']:
-        game_state['lobbies'][lobby_id] = {'players': {}}
-    
-    # Re-sync all player positions from the database
-    lobby_users = User.query.filter_by(current_lobby=lobby_id).all()
-    game_state['lobbies'][lobby_id]['players'] = {}
-    for user in lobby_users:
-        game_state['lobbies'][lobby_id]['players'][user.id] = {
-            'username': user.username,
-            'avatar': user.avatar,
-            'position': json.loads(user.position),
-            'health': user.health,
-            'lifetime_score': user.lifetime_score,
-            'wins': user.wins
-        }
+    if seated or reserved:
+        lobby_directory.joined(lobby_id)
+    user_cache.update(current_user.id, current_lobby=lobby_id)
+    enter_lobby_rooms(state)
+    load_unlocked_achievements(current_user.id)
+    state.add_player(current_user)
+    state.force_keyframe = True
     
+    players = state.snapshot(viewer=current_user.id)
     logging.info(f'User {current_user.username} joined lobby {lobby_id}')
-    logging.info(f"Updated lobby state: {json.dumps(game_state['lobbies'][lobby_id])}")
-    emit('player_joined', {'players': game_state['lobbies'][lobby_id]['players'], 'current_user_id': current_user.id}, room=f'lobby_{lobby_id}')
+    logging.info(f"Updated lobby state: {json.dumps(players)}")
+    emit('player_joined', {
+        'players': players,
+        'current_user_id': current_user.id,
+        'grid': {'width': state.grid.width, 'height': state.grid.height}
+    }, room=None if state.view_radius else f'lobby_{lobby_id}')
+
+@socketio.on('find_match')
+@instrumented('find_match')
+@rate_limited('find_match')
+def handle_find_match():
+    """Queue for matchmaking; ``match_found`` names the lobby to join."""
+    if not current_user.is_authenticated:
+        emit('join_error', {'error': 'Not authenticated'})
+        return
+    position = matchmaker.enqueue(request.sid, current_user.id, player_skill(current_user))
+    emit('match_queued', {'position': position})
+
+@socketio.on('cancel_match')
+@instrumented('cancel_match')
+def handle_cancel_match():
+    if current_user.is_authenticated:
+        matchmaker.cancel(current_user.id)
+
+@socketio.on('watch_lobbies')
+@instrumented('watch_lobbies')
+def handle_watch_lobbies():
+    """Subscribe to lobby_event pushes while on the lobby screen."""
+    join_room('lobby_list')
+
+@socketio.on('unwatch_lobbies')
+@instrumented('unwatch_lobbies')
+def handle_unwatch_lobbies():
+    leave_room('lobby_list')
 
 @socketio.on('move')
+@instrumented('move')
+@rate_limited('move')
 def handle_move(data):
     if current_user.is_authenticated and current_user.current_lobby:
         lobby_id = current_user.current_lobby
-        if lobby_id in game_state['lobbies']:
-            new_pos = data['position']
-            # Re-sync all player positions from the database
-            lobby_users = User.query.filter_by(current_lobby=lobby_id).all()
-            occupied = {(json.loads(user.position)['x'], json.loads(user.position)['y']) for user in lobby_users if user.id != current_user.id}
-            # Only allow move if the cell is not occupied
-            if (new_pos['x'], new_pos['y']) in occupied:
-                return  # Block the move, do not update position
-            current_user.position = json.dumps(new_pos)
-            db.session.commit()
-            # Re-sync all player positions from the database
-            lobby_users = User.query.filter_by(current_lobby=lobby_id).all()
-            game_state['lobbies'][lobby_id]['players'] = {}
-            for user in lobby_users:
-                game_state['lobbies'][lobby_id]['players'][user.id] = {
-                    'username': user.username,
-                    'avatar': user.avatar,
-                    'position': json.loads(user.position),
-                    'health': user.health,
-                    'lifetime_score': user.lifetime_score
-                }
-            emit('player_moved', {
-                'players': game_state['lobbies'][lobby_id]['players'],
-                'player_id': current_user.id,
-                'position': new_pos
-            }, room=f'lobby_{lobby_id}')
+        lobby = get_lobby_state(lobby_id)
+        if lobby is not None:
+            try:
+                new_pos = {'x': int(data['position']['x']), 'y': int(data['position']['y'])}
+            except (KeyError, TypeError, ValueError, OverflowError):
+                return
+            # Applied and broadcast on the next tick; a move off the grid
+            # is dropped here and one into an occupied cell there.
+            if lobby.queue_move(current_user.id, new_pos['x'], new_pos['y']):
+                input_limiter.count('move', 'coalesced')
         else:
             logging.error(f"Lobby {lobby_id} not found in game state!")
 
+@socketio.on('request_keyframe')
+@instrumented('request_keyframe')
+@rate_limited('request_keyframe')
+def handle_request_keyframe():
+    """Resend the full lobby state to a client that missed a delta."""
+    if not (current_user.is_authenticated and current_user.current_lobby):
+        return
+    lobby = get_lobby_state(current_user.current_lobby)
+    if lobby is None:
+        return
+    if lobby.view_radius:
+        lobby.resync(current_user.id)
+    else:
+        emit('state_keyframe', lobby.keyframe())
+
 @socketio.on('attack')
+@instrumented('attack')
+@rate_limited('attack')
 def handle_attack(data):
     if not (current_user.is_authenticated and current_user.current_lobby):
         return
 
     lobby_id = current_user.current_lobby
-    if lobby_id not in game_state['lobbies']:
+    lobby = get_lobby_state(lobby_id)
+    if lobby is None:
+        return
+    data = data if isinstance(data, dict) else {}
+    attack_type = 'ranged' if data.get('type') == 'ranged' else 'melee'
+    if not attack_ready(lobby, current_user.id, attack_type):
         return
 
-    lobby_players = game_state['lobbies'][lobby_id]['players']
-    attacker_pos = json.loads(current_user.position)
-    hit_player_id = None
-
-    # Check for hits
-    for pid, player in lobby_players.items():
-        if int(pid) != current_user.id:
-            player_pos = player['position']
-            if (abs(player_pos['x'] - attacker_pos['x']) <= 1 and 
-                abs(player_pos['y'] - attacker_pos['y']) <= 1):
-                hit_player_id = int(pid)
-                break
-
-    if hit_player_id:
-        target = User.query.get(hit_player_id)
-        if target:
-            damage = 20
-            target.health -= damage
-
-            if target.health <= 0:
-                # Update both current game score and lifetime score
-                current_user.kills += 1
-                current_user.score += 100
-                current_user.lifetime_score += 100
-                target.deaths += 1
-                target.health = 100
+    if attack_type == 'ranged':
+        # resolved by the tick as the projectile travels
+        direction = data.get('direction')
+        if direction not in DIRECTIONS:
+            return
+        projectile = lobby.fire_projectile(current_user.id, *DIRECTIONS[direction])
+        if projectile is None:
+            return
+        emit_to_lobby(lobby, 'attack_launched', {
+            'player_id':     current_user.id,
+            'attack_type':   'ranged',
+            'projectile_id': projectile.id,
+            'position':      {'x': projectile.x, 'y': projectile.y},
+            'direction':     direction,
+            'speed':         app.config['PROJECTILE_SPEED'],
+            'range':         projectile.cells_left
+        }, about=current_user.id)
+        return
 
-                # respawn...
-                grid_w, grid_h = 20, 15
-                taken = {(p['position']['x'], p['position']['y'])
-                         for pid, p in lobby_players.items() if int(pid) != hit_player_id}
-                empty = [(x, y) for x in range(grid_w) for y in range(grid_h)
-                         if (x, y) not in taken]
-                rx, ry = (random.choice(empty) if empty else (0, 0))
-                target.position = json.dumps({'x': rx, 'y': ry})
-                lobby_players[hit_player_id]['position'] = {'x': rx, 'y': ry}
+    result = None
+    with lobby.lock:
+        attacker = lobby.players.get(current_user.id)
+        if attacker is None:
+            return
+        attacker_pos = attacker.position
+        lobby.replay.attack(lobby.tick, current_user.id)
 
-                check_achievements(current_user)
+        # Check for hits: melee reaches the 8 surrounding cells
+        targets = lobby.targets_in_range(current_user.id, 1)
+        hit_player_id = targets[0] if targets else None
 
-                # --- WIN CONDITION: first to 10 kills ---
-                if current_user.kills >= 10:
-                    current_user.wins += 1
-                    current_user.lifetime_score += 500  # Bonus points for winning
-                    db.session.commit()
-                    # Reset only the current game scores, not lifetime scores
-                    for pid, p in lobby_players.items():
-                        user = User.query.get(int(pid))
-                        user.kills = 0
-                        user.score = 0
-                        db.session.commit()
-                    emit('game_won', {'winner': current_user.username}, room=f'lobby_{lobby_id}')
+        if hit_player_id:
+            result = lobby.apply_hit(current_user.id, hit_player_id, app.config['MELEE_DAMAGE'])
+            target = lobby.players[hit_player_id].to_dict()
+            attacker = attacker.to_dict()
 
-            db.session.commit()
+    settle_hits(lobby, [result])
 
-            # Update defender stats
-            emit('player_stats_updated', {
-                'player_id': hit_player_id,
-                'health': target.health,
-                'kills': target.kills,
-                'deaths': target.deaths,
-                'lifetime_score': target.lifetime_score,
-                'wins': target.wins,
-                'position': json.loads(target.position)
-            }, room=f'lobby_{lobby_id}')
-
-            # Update attacker stats
-            emit('player_stats_updated', {
-                'player_id': current_user.id,
-                'health': current_user.health,
-                'kills': current_user.kills,
-                'deaths': current_user.deaths,
-                'lifetime_score': current_user.lifetime_score,
-                'wins': current_user.wins
-            }, room=f'lobby_{lobby_id}')
+    if hit_player_id:
+        # Update defender stats
+        emit_to_lobby(lobby, 'player_stats_updated', {
+            'player_id': hit_player_id,
+            'health': target['health'],
+            'kills': target['kills'],
+            'deaths': target['deaths'],
+            'lifetime_score': target['lifetime_score'],
+            'wins': target['wins'],
+            'position': target['position']
+        }, about=hit_player_id)
+
+        # Update attacker stats
+        emit_to_lobby(lobby, 'player_stats_updated', {
+            'player_id': current_user.id,
+            'health': attacker['health'],
+            'kills': attacker['kills'],
+            'deaths': attacker['deaths'],
+            'lifetime_score': attacker['lifetime_score'],
+            'wins': attacker['wins']
+        }, about=current_user.id)
 
     # always broadcast the attack animation
-    emit('attack_launched', {
+    emit_to_lobby(lobby, 'attack_launched', {
         'player_id':   current_user.id,
         'attack_type': 'melee',
         'position':    attacker_pos
-    }, room=f'lobby_{lobby_id}')
-
-@socketio.on('player_hit')
-def handle_player_hit(data):
-    if current_user.is_authenticated and current_user.current_lobby:
-        target_id = data.get('target_id')
-        damage = data.get('damage', 10)
-        
-        target = User.query.get(target_id)
-        if target:
-            target.health -= damage
-            if target.health <= 0:
-                current_user.kills += 1
-                current_user.score += 100
-                target.deaths += 1
-                target.health = 100
-                
-                # Check for achievements
-                check_achievements(current_user)
-            
-            db.session.commit()
-            
-            emit('player_stats_updated', {
-                'player_id': target_id,
-                'health': target.health,
-                'kills': current_user.kills,
-                'deaths': target.deaths,
-                'score': current_user.score
-            }, room=f'lobby_{current_user.current_lobby}')
+    }, about=current_user.id)
 
 @socketio.on('leave_lobby')
+@instrumented('leave_lobby')
 def handle_leave_lobby():
     if not (current_user.is_authenticated and current_user.current_lobby):
         return
@@ -579,46 +3689,56 @@ def handle_leave_lobby():
     lobby_id = current_user.current_lobby
     room_name = f'lobby_{lobby_id}'
 
-    # remove them from the room state
-    leave_room(room_name)
-    if lobby_id in game_state['lobbies']:
-        game_state['lobbies'][lobby_id]['players'].pop(current_user.id, None)
+    # remove them from the room state, saving any unflushed stats
+    exit_lobby_rooms()
+    remove_player_from_lobby(lobby_id, current_user.id)
 
-    # clear their current_lobby in DB
+    # clear their current_lobby in DB, giving the seat back first (see
+    # LobbyDirectory)
+    lobby_directory.adjust(lobby_id, -1)
     current_user.current_lobby = None
     db.session.commit()
+    user_cache.update(current_user.id, current_lobby=None)
 
     # tell everyone else they left
     emit('player_left', {'player_id': current_user.id}, room=room_name)
 
-def check_achievements(user):
-    achievements = Achievement.query.all()
-    for achievement in achievements:
-        if not UserAchievement.query.filter_by(user_id=user.id, achievement_id=achievement.id).first():
-            if achievement.requirement == 'kills_10' and user.kills >= 10:
-                unlock_achievement(user, achievement)
-            elif achievement.requirement == 'wins_5' and user.wins >= 5:
-                unlock_achievement(user, achievement)
-            elif achievement.requirement == 'score_1000' and user.score >= 1000:
-                unlock_achievement(user, achievement)
-
-def unlock_achievement(user, achievement):
-    user_achievement = UserAchievement(user_id=user.id, achievement_id=achievement.id)
-    db.session.add(user_achievement)
-    db.session.commit()
-    
-    emit('achievement_unlocked', {
-        'name': achievement.name,
-        'description': achievement.description,
-        'icon': achievement.icon
-    }, room=f'lobby_{user.current_lobby}')
-
-
 # ─── APP STARTUP ───────────────────────────────────────────────────────────────
-
-if __name__ == '__main__':
+#
+# Importing this module only defines things. startup() then brings the
+# process up in timed phases, once each: logging (open the log files,
+# start the listener), database (bind the engine, create, migrate and
+# seed), assets (hash and precompress static/) and caches (achievements,
+# leaderboard, lobby list and the users of this worker's lobbies, who are
+# the first to reconnect after a deploy). __main__ calls it before
+# listening; StartupGate runs it ahead of the first request or socket
+# handshake for any other server.
+
+_startup_lock = threading.RLock()
+startup_phases = {}  # phase -> seconds it took, in the order run
+startup_complete = False
+
+
+def startup_phase(name, fn):
+    """Run ``fn`` as phase ``name`` unless it already ran in this process.
+
+    A phase that raises is not recorded, so the next call retries it.
+    """
+    with _startup_lock:
+        if name in startup_phases:
+            return
+        started = time.perf_counter()
+        fn()
+        startup_phases[name] = time.perf_counter() - started
+
+
+def setup_database():
+    db.init_app(app)
     with app.app_context():
         db.create_all()
+        # brings tables create_all left alone up to date; a fresh schema
+        # is only stamped
+        migrate.upgrade(db.engine, log=logger.info, max_rows=app.config['MIGRATE_MAX_ROWS'])
         # Create default achievements if needed…
         if not Achievement.query.first():
             defaults = [
@@ -629,4 +3749,149 @@ if __name__ == '__main__':
             db.session.add_all(defaults)
             db.session.commit()
 
-    socketio.run(app, host='0.0.0.0', port=8080, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
+
+def warm_caches():
+    with app.app_context():
+        achievement_registry.load()
+        ranking.load()
+        lobby_directory.load()
+        members = User.query.filter(User.current_lobby.isnot(None)).all()
+        for user in members:
+            if owns_lobby(user.current_lobby):
+                user_cache.put(user)
+
+
+def init_db():
+    """Create, migrate and seed the database; does nothing the second time."""
+    startup_phase('logging', start_logging)
+    startup_phase('database', setup_database)
+
+
+def startup():
+    """Make this process ready to serve; returns {phase: seconds}."""
+    global startup_complete
+    if startup_complete:
+        return startup_phases
+    with _startup_lock:
+        if startup_complete:
+            return startup_phases
+        init_db()
+        startup_phase('assets', load_assets)
+        startup_phase('caches', warm_caches)
+        startup_complete = True
+    summary = ' '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in startup_phases.items())
+    total = sum(startup_phases.values()) * 1000
+    logger.info(f"startup: {summary} total={total:.1f}ms")
+    return startup_phases
+
+
+class StartupGate:
+    """WSGI middleware that finishes ``startup`` before serving anything.
+
+    It wraps the Socket.IO middleware as well, so a socket handshake waits
+    for it too. Concurrent first requests queue on the startup lock.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not startup_complete:
+            startup()
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = StartupGate(app.wsgi_app)
+
+
+@metrics.collector
+def collect_startup_metrics():
+    return [('startup_phase_seconds', 'gauge', 'Time this process spent in each startup phase',
+             [({'phase': name}, seconds) for name, seconds in startup_phases.items()])]
+
+
+def startup_self_check():
+    """Report the server mode, async mode and DB pool, and flag mismatches."""
+    with app.app_context():
+        pool = db.engine.pool
+    report = {
+        'server_mode': SERVER_MODE,
+        'async_mode': socketio.async_mode,
+        'db_pool': type(pool).__name__,
+        'db_pool_size': pool.size() if hasattr(pool, 'size') else None,
+        'db_max_overflow': getattr(pool, '_max_overflow', None),
+        'db_pre_ping': getattr(pool, '_pre_ping', False),
+    }
+    problems = []
+    if ASYNC_MODE == 'eventlet':
+        report['monkey_patched'] = eventlet.patcher.is_monkey_patched('socket')
+    elif ASYNC_MODE == 'gevent':
+        report['monkey_patched'] = monkey.is_module_patched('socket')
+    if SERVER_MODE == 'production':
+        if socketio.async_mode not in ('eventlet', 'gevent'):
+            problems.append(f"production mode on blocking async_mode={socketio.async_mode}")
+        if not report.get('monkey_patched'):
+            problems.append('standard library is not monkey patched')
+    with app.app_context():
+        try:
+            db.session.execute(db.text('SELECT 1'))
+            steps = [number for number, _, _, _ in migrate.pending(db.engine)]
+            if steps:
+                problems.append(f"migrations {steps} pending; run `python migrate.py upgrade`")
+        except Exception as e:
+            problems.append(f"database unreachable: {e}")
+    summary = ' '.join(f"{k}={v}" for k, v in report.items())
+    logger.info(f"startup self-check: {summary}")
+    for problem in problems:
+        logger.warning(f"startup self-check: {problem}")
+    return report, problems
+
+
+def run_cluster(workers, port, host):
+    """Run ``workers`` worker processes on consecutive ports behind the local broker."""
+    queue_url = app.config['SOCKETIO_MESSAGE_QUEUE'] or 'local://127.0.0.1:5055'
+    if queue_url.startswith('local://'):
+        threading.Thread(
+            target=run_local_broker,
+            args=(parse_local_queue(queue_url), local_broker_authkey()),
+            daemon=True
+        ).start()
+    urls = app.config['WORKER_URLS'] or [
+        f"http://{host}:{port + i}" for i in range(workers)
+    ]
+    procs = []
+    for i in range(workers):
+        env = dict(os.environ,
+                   WORKER_ID=str(i), PORT=str(port + i),
+                   WORKER_URLS=','.join(urls),
+                   SOCKETIO_MESSAGE_QUEUE=queue_url)
+        procs.append(subprocess.Popen([sys.executable, __file__, '--worker'], env=env))
+        print(f"worker {i} -> {urls[i]}")
+    try:
+        for proc in procs:
+            proc.wait()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Grid Combat Fighter server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run this many worker processes, sharding lobbies between them')
+    parser.add_argument('--host', default='localhost',
+                        help='host name clients use to reach the workers')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        init_db()
+        run_cluster(args.workers, app.config['PORT'], args.host)
+    else:
+        startup()
+        startup_self_check()
+        if SERVER_MODE == 'production':
+            socketio.run(app, host='0.0.0.0', port=app.config['PORT'])
+        else:
+            socketio.run(app, host='0.0.0.0', port=app.config['PORT'], debug=True,
+                         use_reloader=not args.worker, allow_unsafe_werkzeug=True)
@@ -0,0 +1,458 @@
+"""Load test for the game server using simulated Socket.IO players.
+
+Each bot registers and logs in over HTTP, opens a Socket.IO connection,
+joins a lobby and then sends a weighted mix of moves and attacks at a fixed
+rate. The run reports:
+
+- round-trip latency percentiles per event type. A move counts as done when
+  the bot sees its own new position in a tick update; an attack counts as
+  done on its own ``attack_launched``;
+- broadcast fan-out, i.e. how many messages all bots received per second;
+- database statements per sent event, from the server's ``/metrics``.
+
+Examples:
+
+    python bench.py --bots 40 --lobbies 4 --duration 20
+    DATABASE_URL=postgresql://... python bench.py --bots 100
+    python bench.py --url http://localhost:8080 --bots 200 --codec binary
+
+Without ``--url`` the server is started in this process on a free port,
+against ``DATABASE_URL`` or a temporary SQLite file. ``--json`` prints the
+report as one JSON object, for comparing runs in CI.
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import socket
+import struct
+import logging
+import argparse
+import contextlib
+import tempfile
+import threading
+from collections import Counter, defaultdict
+
+import requests
+import socketio
+
+# binary tick frames; must match WIRE CODEC in app.py
+STATE_HEADER = struct.Struct('<BIIHH')
+PLAYER_RECORD = struct.Struct('<IhhhIHII')
+STEPS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+DB_QUERIES = re.compile(r'^db_queries_total\{handler="([^"]*)"\} (\S+)$')
+# give up on an unanswered event after this many seconds
+EVENT_TIMEOUT = 2.0
+# keep retrying a throttled register/login for this many seconds
+SIGNUP_TIMEOUT = 120.0
+
+
+def parse_mix(spec):
+    """Parse ``"move=0.8,attack=0.15,ranged=0.05"`` into {event: weight}."""
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        event, _, weight = item.partition('=')
+        if event not in ('move', 'attack', 'ranged'):
+            raise ValueError(f"unknown event in mix: {event}")
+        mix[event] = float(weight)
+    return mix
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(int(round(pct / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Stats:
+    """Counters and latency samples shared by every bot."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = Counter()
+        self.timeouts = Counter()
+        self.latencies = defaultdict(list)
+        self.received = Counter()
+        self.received_bytes = 0
+        self.recording = False
+
+    def record_sent(self, event):
+        if self.recording:
+            with self.lock:
+                self.sent[event] += 1
+
+    def record_latency(self, event, seconds):
+        if self.recording:
+            with self.lock:
+                self.latencies[event].append(seconds)
+
+    def record_timeout(self, event):
+        if self.recording:
+            with self.lock:
+                self.timeouts[event] += 1
+
+    def record_received(self, event, size=0):
+        if self.recording:
+            with self.lock:
+                self.received[event] += 1
+                self.received_bytes += size
+
+
+class Bot:
+    """One simulated player: an HTTP session plus a Socket.IO client."""
+
+    def __init__(self, base_url, username, codec, stats):
+        self.base_url = base_url
+        self.username = username
+        self.codec = codec
+        self.stats = stats
+        self.http = requests.Session()
+        self.sio = socketio.Client(http_session=self.http, reconnection=False)
+        self.user_id = None
+        self.position = None
+        self.grid = (20, 15)
+        self.joined = threading.Event()
+        self.lock = threading.Lock()
+        self.pending_move = None    # (target position, sent at)
+        self.pending_attack = None  # (event, sent at)
+        self._register_handlers()
+
+    def _post_auth(self, path, credentials):
+        # a remote server throttles register/login per client IP
+        # (AUTH_RATE_LIMITS), so back off until its bucket refills
+        delay, deadline = 0.5, time.monotonic() + SIGNUP_TIMEOUT
+        while True:
+            r = self.http.post(f"{self.base_url}{path}", json=credentials)
+            if r.status_code != 429 or time.monotonic() + delay > deadline:
+                return r
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+    def signup(self):
+        credentials = {'username': self.username, 'password': 'bench-password'}
+        # an existing name from an earlier run just logs in
+        self._post_auth('/register', credentials)
+        r = self._post_auth('/login', credentials)
+        r.raise_for_status()
+
+    def connect(self, url=None):
+        self.sio.connect(url or self.base_url, auth={'codec': self.codec},
+                         transports=['websocket'])
+
+    def join(self, lobby_id, timeout=10):
+        self.joined.clear()
+        self.sio.emit('join_lobby', {'lobby_id': lobby_id})
+        if not self.joined.wait(timeout):
+            raise RuntimeError(f"{self.username} could not join lobby {lobby_id}")
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+    # --- inbound -------------------------------------------------------------
+
+    def _register_handlers(self):
+        sio = self.sio
+
+        @sio.on('player_joined')
+        def on_joined(data):
+            self.stats.record_received('player_joined')
+            if self.user_id is None:
+                self.user_id = data['current_user_id']
+            if data.get('grid'):
+                self.grid = (data['grid']['width'], data['grid']['height'])
+            me = data['players'].get(str(self.user_id))
+            if me is not None:
+                self._see_position(me['position'])
+                self.joined.set()
+
+        @sio.on('state_keyframe')
+        def on_keyframe(data):
+            self.stats.record_received('state_keyframe')
+            me = data['players'].get(str(self.user_id))
+            if me is not None:
+                self._see_position(me['position'])
+
+        @sio.on('state_delta')
+        def on_delta(data):
+            self.stats.record_received('state_delta')
+            me = data['players'].get(str(self.user_id))
+            if me is not None and 'position' in me:
+                self._see_position(me['position'])
+
+        @sio.on('state_bin')
+        def on_state_bin(frame):
+            self.stats.record_received('state_bin', len(frame))
+            _, _, _, count, _ = STATE_HEADER.unpack_from(frame)
+            offset = STATE_HEADER.size
+            for _ in range(count):
+                pid, x, y = PLAYER_RECORD.unpack_from(frame, offset)[:3]
+                if pid == self.user_id:
+                    self._see_position({'x': x, 'y': y})
+                offset += PLAYER_RECORD.size
+
+        @sio.on('attack_launched')
+        def on_attack(data):
+            self.stats.record_received('attack_launched')
+            if data.get('player_id') == self.user_id:
+                with self.lock:
+                    pending, self.pending_attack = self.pending_attack, None
+                if pending is not None:
+                    self.stats.record_latency(pending[0], time.perf_counter() - pending[1])
+
+        @sio.on('lobby_redirect')
+        def on_redirect(data):
+            # multi-worker server: this lobby lives on another worker
+            def move_over():
+                self.sio.disconnect()
+                self.connect(data['url'])
+                self.sio.emit('join_lobby', {'lobby_id': data['lobby_id']})
+            threading.Thread(target=move_over, daemon=True).start()
+
+        @sio.on('*')
+        def on_other(event, *args):
+            self.stats.record_received(event)
+
+    def _see_position(self, position):
+        with self.lock:
+            self.position = (position['x'], position['y'])
+            pending = self.pending_move
+            if pending and pending[0] == self.position:
+                self.pending_move = None
+        if pending and pending[0] == self.position:
+            self.stats.record_latency('move', time.perf_counter() - pending[1])
+
+    # --- outbound ------------------------------------------------------------
+
+    def act(self, event):
+        """Send one ``event`` unless the previous one is still in flight."""
+        now = time.perf_counter()
+        with self.lock:
+            if self.position is None:
+                return
+            if self.pending_move and now - self.pending_move[1] > EVENT_TIMEOUT:
+                self.pending_move = None
+                self.stats.record_timeout('move')
+            if self.pending_attack and now - self.pending_attack[1] > EVENT_TIMEOUT:
+                self.stats.record_timeout(self.pending_attack[0])
+                self.pending_attack = None
+            if event == 'move':
+                if self.pending_move:
+                    return
+                dx, dy = random.choice(list(STEPS.values()))
+                x = min(max(self.position[0] + dx, 0), self.grid[0] - 1)
+                y = min(max(self.position[1] + dy, 0), self.grid[1] - 1)
+                if (x, y) == self.position:
+                    return
+                self.pending_move = ((x, y), now)
+                payload = {'position': {'x': x, 'y': y}}
+                name = 'move'
+            else:
+                if self.pending_attack:
+                    return
+                self.pending_attack = (event, now)
+                name = 'attack'
+                if event == 'ranged':
+                    payload = {'type': 'ranged', 'direction': random.choice(list(STEPS))}
+                else:
+                    payload = {'type': 'melee'}
+        self.stats.record_sent(event)
+        self.sio.emit(name, payload)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def scrape_db_queries(base_url):
+    """``db_queries_total`` per handler from the server's /metrics, or None."""
+    try:
+        r = requests.get(f"{base_url}/metrics", timeout=5)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+    counts = Counter()
+    for line in r.text.splitlines():
+        match = DB_QUERIES.match(line)
+        if match:
+            counts[match.group(1)] = float(match.group(2))
+    return counts
+
+
+def start_local_server(database_url):
+    """Run app.py in this process; returns its base URL."""
+    os.environ['DATABASE_URL'] = database_url
+    # every bot signs up from 127.0.0.1; don't throttle them per IP
+    os.environ['AUTH_RATE_LIMITS'] = ''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as game
+
+    # the dev server reports every websocket the bots close as an error
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    # keep the server banner out of stdout, which may be carrying --json
+    with contextlib.redirect_stdout(sys.stderr):
+        game.startup()
+        threading.Thread(
+            target=game.socketio.run, args=(game.app,),
+            kwargs={'host': '127.0.0.1', 'port': port, 'allow_unsafe_werkzeug': True,
+                    'log_output': False},
+            daemon=True
+        ).start()
+        for _ in range(100):
+            try:
+                requests.get(f"{base_url}/lobbies", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+    return base_url
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    events, weights = list(mix), list(mix.values())
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        database_url = os.environ.get('DATABASE_URL') or \
+            f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+        base_url = start_local_server(database_url)
+
+    stats = Stats()
+    run_id = f"{int(time.time()) % 100000}{random.randint(0, 99):02d}"
+    bots = [Bot(base_url, f"bench_{run_id}_{i}", args.codec, stats) for i in range(args.bots)]
+
+    setup_started = time.perf_counter()
+    per_lobby = -(-args.bots // args.lobbies)
+    lobby_ids = []
+    for i in range(args.lobbies):
+        owner = bots[i * per_lobby] if i * per_lobby < len(bots) else bots[0]
+        owner.signup()
+        r = owner.http.post(f"{base_url}/lobbies",
+                            json={'name': f"bench {run_id} #{i}", 'max_players': per_lobby})
+        r.raise_for_status()
+        lobby_ids.append(r.json()['id'])
+    for i, bot in enumerate(bots):
+        if i % per_lobby:
+            bot.signup()
+        bot.connect()
+        bot.join(lobby_ids[i // per_lobby])
+    setup_seconds = time.perf_counter() - setup_started
+
+    stop = threading.Event()
+
+    def drive(bot):
+        interval = 1.0 / args.rate
+        next_at = time.perf_counter() + random.random() * interval
+        while not stop.is_set():
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+            try:
+                bot.act(random.choices(events, weights)[0])
+            except Exception:
+                if not stop.is_set():
+                    raise
+
+    threads = [threading.Thread(target=drive, args=(bot,), daemon=True) for bot in bots]
+    for t in threads:
+        t.start()
+    time.sleep(args.warmup)
+    queries_before = scrape_db_queries(base_url)
+    stats.recording = True
+    measure_started = time.perf_counter()
+    time.sleep(args.duration)
+    stats.recording = False
+    queries_after = scrape_db_queries(base_url)
+    elapsed = time.perf_counter() - measure_started
+    stop.set()
+    for t in threads:
+        t.join(timeout=2)
+    for bot in bots:
+        bot.close()
+
+    sent_total = sum(stats.sent.values())
+    queries = None
+    if queries_before is not None and queries_after is not None:
+        queries = Counter({handler: n - queries_before[handler]
+                           for handler, n in queries_after.items()
+                           if n - queries_before[handler] > 0})
+    report = {
+        'bots': args.bots,
+        'lobbies': args.lobbies,
+        'codec': args.codec,
+        'setup_seconds': round(setup_seconds, 2),
+        'duration_seconds': round(elapsed, 2),
+        'events': {},
+        'fanout': {
+            'messages_per_second': round(sum(stats.received.values()) / elapsed, 1),
+            'per_bot_per_second': round(sum(stats.received.values()) / elapsed / max(args.bots, 1), 1),
+            'by_event': dict(stats.received),
+            'binary_bytes': stats.received_bytes,
+        },
+        'db_statements_per_event': (
+            round(sum(queries.values()) / sent_total, 3) if queries is not None and sent_total else None
+        ),
+        'db_statements_by_handler': dict(queries) if queries is not None else None,
+    }
+    for event in sorted(set(stats.sent) | set(stats.latencies)):
+        samples = sorted(stats.latencies.get(event, []))
+        report['events'][event] = {
+            'sent': stats.sent[event],
+            'completed': len(samples),
+            'timeouts': stats.timeouts[event],
+            'sent_per_second': round(stats.sent[event] / elapsed, 1),
+            **{f"p{p}_ms": (round(percentile(samples, p) * 1000, 2) if samples else None)
+               for p in (50, 95, 99)},
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{report['bots']} bots in {report['lobbies']} lobbies, codec={report['codec']}, "
+          f"{report['duration_seconds']}s measured (setup {report['setup_seconds']}s)")
+    print(f"{'event':<8} {'sent/s':>8} {'done':>7} {'timeout':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for event, row in report['events'].items():
+        cells = [f"{row[k]:>8}" if row[k] is not None else f"{'-':>8}"
+                 for k in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{event:<8} {row['sent_per_second']:>8} {row['completed']:>7} {row['timeouts']:>8} {' '.join(cells)}")
+    fanout = report['fanout']
+    print(f"fan-out: {fanout['messages_per_second']} msg/s received "
+          f"({fanout['per_bot_per_second']} per bot)")
+    if report['db_statements_per_event'] is not None:
+        print(f"db statements per sent event: {report['db_statements_per_event']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated-player load test')
+    parser.add_argument('--url', help='server to test; default: start one in this process')
+    parser.add_argument('--bots', type=int, default=20)
+    parser.add_argument('--lobbies', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=15, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=2, help='unmeasured seconds first')
+    parser.add_argument('--rate', type=float, default=4, help='events per bot per second')
+    parser.add_argument('--mix', default='move=0.8,attack=0.15,ranged=0.05',
+                        help='relative weights of move/attack/ranged')
+    parser.add_argument('--codec', choices=('json', 'binary'), default='json')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
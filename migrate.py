@@ -0,0 +1,485 @@
+"""Schema migrations for the game database, plus a query benchmark.
+
+The app creates missing tables with ``db.create_all()``, but that never
+changes a table that already exists. This tool brings an existing
+database up to date, one numbered step at a time. It records the version
+reached in a ``schema_version`` table. Every step checks the live schema
+first, so it is safe to re-run and a database that ``create_all`` built
+from the current models is just stamped.
+
+Steps:
+
+1. add integer ``pos_x``/``pos_y`` columns to ``user``;
+2. backfill them from the JSON ``position`` column, in id-range batches
+   (also ``python migrate.py backfill``);
+3. index ``user.current_lobby`` and ``user.lifetime_score``;
+4. drop duplicate ``user_achievement`` rows and add a unique index on
+   ``(user_id, achievement_id)``;
+5. add ``user.updated_at``, set on every write to a user, from which
+   other workers refresh their leaderboard;
+6. index it.
+
+The server runs ``upgrade`` at startup, but skips the bulk steps (2-4 and 6)
+when ``user`` has more than ``MIGRATE_MAX_ROWS`` rows so a deploy never waits
+on a long backfill; run ``python migrate.py upgrade`` for those.
+
+``python migrate.py contract`` then drops ``user.position``, once no
+running server still reads it. On Postgres, indexes are built
+``CONCURRENTLY`` so writes carry on during the build.
+
+``python migrate.py bench --users 1000000`` measures the hot queries
+before and after the migration. It uses a scratch database that must be
+empty (``DATABASE_URL``, or a temporary SQLite file): it creates the old
+schema, seeds it, records each query's plan and latency, runs ``upgrade``
+and measures again.
+
+Examples:
+
+    python migrate.py status
+    python migrate.py upgrade
+    python migrate.py backfill --batch 20000
+    DATABASE_URL=postgresql://.../scratch python migrate.py bench --users 1000000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+import sqlalchemy as sa
+
+BACKFILL_BATCH = 10000
+
+
+def quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def columns(conn, table):
+    return {c['name'] for c in sa.inspect(conn).get_columns(table)}
+
+
+def indexes(conn, table):
+    return {i['name'] for i in sa.inspect(conn).get_indexes(table)}
+
+
+def has_index(conn, name, table):
+    """Whether index ``name`` exists and is usable.
+
+    On Postgres an interrupted CREATE INDEX CONCURRENTLY leaves an INVALID
+    index that queries ignore; that counts as missing.
+    """
+    if conn.dialect.name != 'postgresql':
+        return name in indexes(conn, table)
+    return bool(conn.execute(sa.text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+    ), {'name': name}).scalar())
+
+
+def create_index(engine, name, table, cols, unique=False):
+    """CREATE INDEX if missing; CONCURRENTLY (outside a transaction) on Postgres.
+
+    An INVALID leftover of an earlier concurrent build is dropped first.
+    """
+    with engine.connect() as conn:
+        if has_index(conn, name, table):
+            return False
+    postgres = engine.dialect.name == 'postgresql'
+    options = {'isolation_level': 'AUTOCOMMIT'} if postgres else {}
+    with engine.connect().execution_options(**options) as conn:
+        if postgres:
+            conn.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(conn, name)}"))
+        conn.execute(sa.text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX "
+            f"{'CONCURRENTLY ' if postgres else ''}{quote(conn, name)} "
+            f"ON {quote(conn, table)} ({', '.join(quote(conn, c) for c in cols)})"
+        ))
+        conn.commit()
+    return True
+
+
+# ─── STEPS ─────────────────────────────────────────────────────────────────────
+
+def add_column(conn, table, name, ddl):
+    if name not in columns(conn, table):
+        conn.execute(sa.text(f"ALTER TABLE {quote(conn, table)} ADD COLUMN {name} {ddl}"))
+
+
+def add_position_columns(engine):
+    with engine.begin() as conn:
+        for col in ('pos_x', 'pos_y'):
+            add_column(conn, 'user', col, 'INTEGER NOT NULL DEFAULT 0')
+
+
+def backfill_positions(engine, batch=BACKFILL_BATCH, progress=None):
+    """Copy ``position`` JSON into ``pos_x``/``pos_y``, ``batch`` ids at a time.
+
+    Each batch is its own short transaction, so the table is never locked
+    for long, and an interrupted run can simply be started again.
+    Returns the number of rows read.
+    """
+    with engine.connect() as conn:
+        if 'position' not in columns(conn, 'user'):
+            return 0
+        user = quote(conn, 'user')
+        last_id = conn.execute(sa.text(f"SELECT MAX(id) FROM {user}")).scalar() or 0
+    done, low = 0, 0
+    while low < last_id:
+        high = low + batch
+        with engine.begin() as conn:
+            if engine.dialect.name == 'postgresql':
+                done += conn.execute(sa.text(
+                    f"UPDATE {user} SET "
+                    f"pos_x = COALESCE((position::json->>'x')::int, 0), "
+                    f"pos_y = COALESCE((position::json->>'y')::int, 0) "
+                    f"WHERE id > :low AND id <= :high AND position IS NOT NULL"
+                ), {'low': low, 'high': high}).rowcount
+            else:
+                rows = conn.execute(sa.text(
+                    f"SELECT id, position FROM {user} "
+                    f"WHERE id > :low AND id <= :high AND position IS NOT NULL"
+                ), {'low': low, 'high': high}).all()
+                updates = []
+                for user_id, position in rows:
+                    try:
+                        pos = json.loads(position)
+                        updates.append({'id': user_id, 'x': int(pos['x']), 'y': int(pos['y'])})
+                    except (ValueError, KeyError, TypeError):
+                        continue  # unreadable: keep the 0, 0 default
+                if updates:
+                    conn.execute(sa.text(
+                        f"UPDATE {user} SET pos_x = :x, pos_y = :y WHERE id = :id"
+                    ), updates)
+                done += len(rows)
+        low = high
+        if progress:
+            progress(min(low, last_id), last_id)
+    return done
+
+
+def add_user_indexes(engine):
+    create_index(engine, 'ix_user_current_lobby', 'user', ['current_lobby'])
+    create_index(engine, 'ix_user_lifetime_score', 'user', ['lifetime_score'])
+
+
+def add_updated_at_column(engine):
+    # left NULL on existing rows: the leaderboard's first load reads every
+    # row, and from then on only rows whose updates set it
+    with engine.begin() as conn:
+        add_column(conn, 'user', 'updated_at', sa.DateTime().compile(dialect=conn.dialect))
+
+
+def add_updated_at_index(engine):
+    create_index(engine, 'ix_user_updated_at', 'user', ['updated_at'])
+
+
+def unique_user_achievements(engine):
+    with engine.connect() as conn:
+        if has_index(conn, 'uq_user_achievement', 'user_achievement'):
+            return
+    with engine.begin() as conn:
+        conn.execute(sa.text(
+            "DELETE FROM user_achievement WHERE id NOT IN ("
+            "SELECT MIN(id) FROM user_achievement GROUP BY user_id, achievement_id)"
+        ))
+    create_index(engine, 'uq_user_achievement', 'user_achievement',
+                 ['user_id', 'achievement_id'], unique=True)
+
+
+# (version, name, step, bulk): a bulk step's cost grows with the number
+# of users, so a server starting up leaves it to this tool on a big table
+MIGRATIONS = [
+    (1, 'add user.pos_x/pos_y', add_position_columns, False),
+    (2, 'backfill pos_x/pos_y from user.position', backfill_positions, True),
+    (3, 'index user.current_lobby and user.lifetime_score', add_user_indexes, True),
+    (4, 'unique user_achievement (user_id, achievement_id)', unique_user_achievements, True),
+    (5, 'add user.updated_at', add_updated_at_column, False),
+    (6, 'index user.updated_at', add_updated_at_index, True),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+def applied(engine):
+    """Numbers of the steps recorded in ``schema_version``."""
+    with engine.begin() as conn:
+        conn.execute(sa.text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        return {v for v, in conn.execute(sa.text("SELECT version FROM schema_version"))}
+
+
+def pending(engine):
+    done = applied(engine)
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def current_version(engine):
+    """The highest step reached with every step before it applied too."""
+    done, version = applied(engine), 0
+    while version + 1 in done:
+        version += 1
+    return version
+
+
+def user_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(sa.text(f"SELECT COUNT(*) FROM {quote(conn, 'user')}")).scalar()
+
+
+def upgrade(engine, log=print, max_rows=None):
+    """Run every step above the recorded version; returns seconds per step.
+
+    With ``max_rows`` (as the server passes at startup), bulk steps are
+    skipped if ``user`` has more rows than that and left to ``python
+    migrate.py upgrade``; the other steps still run, since the models
+    need their columns. Steps don't depend on each other's data, so they
+    may be applied out of order. Once nothing is pending this is a
+    single SELECT.
+    """
+    timings = {}
+    rows = None
+    for number, name, step, bulk in pending(engine):
+        if bulk and max_rows is not None:
+            if rows is None:
+                rows = user_count(engine)
+            if rows > max_rows:
+                log(f"migration {number}: {name} not run, user has {rows} rows; "
+                    f"run `python migrate.py upgrade`")
+                continue
+        started = time.perf_counter()
+        step(engine)
+        timings[name] = time.perf_counter() - started
+        with engine.begin() as conn:
+            conn.execute(sa.text("INSERT INTO schema_version (version) VALUES (:v)"), {'v': number})
+        log(f"migration {number}: {name} ({timings[name]:.2f}s)")
+    return timings
+
+
+def contract(engine):
+    """Drop ``user.position`` once every server reads pos_x/pos_y."""
+    if pending(engine):
+        raise SystemExit('run upgrade first')
+    with engine.begin() as conn:
+        if 'position' in columns(conn, 'user'):
+            conn.execute(sa.text(f"ALTER TABLE {quote(conn, 'user')} DROP COLUMN position"))
+
+
+# ─── BENCHMARK ─────────────────────────────────────────────────────────────────
+
+def create_legacy_schema(engine):
+    """The tables as the app created them before these migrations."""
+    metadata = sa.MetaData()
+    sa.Table('lobby', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('name', sa.String(80), nullable=False),
+             sa.Column('max_players', sa.Integer),
+             sa.Column('created_at', sa.DateTime))
+    sa.Table('user', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('username', sa.String(80), unique=True, nullable=False),
+             sa.Column('password_hash', sa.String(512), nullable=False),
+             sa.Column('avatar', sa.String(200)),
+             sa.Column('position', sa.String(50)),
+             *(sa.Column(name, sa.Integer) for name in
+               ('health', 'score', 'lifetime_score', 'kills', 'deaths', 'wins')),
+             sa.Column('current_lobby', sa.Integer, sa.ForeignKey('lobby.id')))
+    sa.Table('achievement', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('name', sa.String(80), nullable=False),
+             sa.Column('description', sa.String(200), nullable=False),
+             sa.Column('requirement', sa.String(50), nullable=False),
+             sa.Column('icon', sa.String(200)))
+    sa.Table('user_achievement', metadata,
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+             sa.Column('achievement_id', sa.Integer, sa.ForeignKey('achievement.id'), nullable=False),
+             sa.Column('achieved_at', sa.DateTime))
+    metadata.create_all(engine)
+    return metadata
+
+
+def seed(engine, metadata, users, lobbies, chunk=50000, progress=None):
+    """Fill the legacy tables: ``users`` players, a fifth of them in lobbies."""
+    rng = random.Random(1)
+    t = metadata.tables
+    with engine.begin() as conn:
+        conn.execute(t['lobby'].insert(), [
+            {'id': i, 'name': f'lobby {i}', 'max_players': 8} for i in range(1, lobbies + 1)])
+        conn.execute(t['achievement'].insert(), [
+            {'id': 1, 'name': 'Killer', 'description': 'Get 10 kills', 'requirement': 'kills_10'},
+            {'id': 2, 'name': 'Champion', 'description': 'Win 5 games', 'requirement': 'wins_5'},
+            {'id': 3, 'name': 'Master', 'description': 'Reach 1000 points', 'requirement': 'score_1000'},
+        ])
+    achievement_id = 0
+    for start in range(1, users + 1, chunk):
+        ids = range(start, min(start + chunk, users + 1))
+        rows, earned = [], []
+        for i in ids:
+            kills = rng.randrange(50)
+            rows.append({
+                'id': i, 'username': f'player{i}', 'password_hash': 'x',
+                'position': json.dumps({'x': rng.randrange(20), 'y': rng.randrange(15)}),
+                'health': 100, 'score': 0, 'lifetime_score': rng.randrange(100000),
+                'kills': kills, 'deaths': rng.randrange(50), 'wins': rng.randrange(20),
+                'current_lobby': rng.randrange(1, lobbies + 1) if rng.random() < 0.2 else None,
+            })
+            for a in (1, 2, 3):
+                if rng.random() < 0.3:
+                    achievement_id += 1
+                    earned.append({'id': achievement_id, 'user_id': i, 'achievement_id': a})
+        with engine.begin() as conn:
+            conn.execute(t['user'].insert(), rows)
+            if earned:
+                conn.execute(t['user_achievement'].insert(), earned)
+        if progress:
+            progress(ids[-1], users)
+
+
+def hot_queries(users, lobbies):
+    """(name, SQL, parameter factory) for the statements handlers run most."""
+    return [
+        ('join: players of a lobby',
+         'SELECT * FROM "user" WHERE current_lobby = :lobby',
+         lambda rng: {'lobby': rng.randrange(1, lobbies + 1)}),
+        ('win: reset a lobby\'s scores',
+         'UPDATE "user" SET kills = 0, score = 0 WHERE current_lobby = :lobby',
+         lambda rng: {'lobby': rng.randrange(1, lobbies + 1)}),
+        ('lobby list: member counts',
+         'SELECT lobby.id, COUNT("user".id) FROM lobby LEFT OUTER JOIN "user" '
+         'ON "user".current_lobby = lobby.id GROUP BY lobby.id',
+         lambda rng: {}),
+        ('leaderboard: top 10',
+         'SELECT id, username, lifetime_score FROM "user" ORDER BY lifetime_score DESC LIMIT 10',
+         lambda rng: {}),
+        ('achievements: unlocked by a user',
+         'SELECT achievement_id FROM user_achievement WHERE user_id = :user',
+         lambda rng: {'user': rng.randrange(1, users + 1)}),
+        ('achievements: already unlocked?',
+         'SELECT id FROM user_achievement WHERE user_id = :user AND achievement_id = :a',
+         lambda rng: {'user': rng.randrange(1, users + 1), 'a': rng.randrange(1, 4)}),
+    ]
+
+
+def explain(conn, sql, params):
+    if conn.dialect.name == 'postgresql':
+        rows = conn.execute(sa.text(f'EXPLAIN {sql}'), params).all()
+        return [r[0] for r in rows]
+    rows = conn.execute(sa.text(f'EXPLAIN QUERY PLAN {sql}'), params).all()
+    return [r[-1] for r in rows]
+
+
+def measure(engine, queries, runs):
+    """Plan and latency (ms) of each query; writes are rolled back."""
+    rng = random.Random(2)
+    results = {}
+    for name, sql, params in queries:
+        with engine.connect() as conn:
+            sql = sql.replace('"user"', quote(conn, 'user'))
+            plan = explain(conn, sql, params(rng))
+            times = []
+            for _ in range(runs):
+                args = params(rng)
+                started = time.perf_counter()
+                result = conn.execute(sa.text(sql), args)
+                if result.returns_rows:
+                    result.all()
+                times.append((time.perf_counter() - started) * 1000)
+                conn.rollback()
+        times.sort()
+        results[name] = {
+            'plan': plan,
+            'p50_ms': round(times[len(times) // 2], 3),
+            'p95_ms': round(times[min(int(len(times) * 0.95), len(times) - 1)], 3),
+        }
+    return results
+
+
+def bench(database_url, users, lobbies, runs, log=print):
+    engine = sa.create_engine(database_url)
+    with engine.connect() as conn:
+        if sa.inspect(conn).get_table_names():
+            raise SystemExit('bench needs an empty database; it creates and fills its own tables')
+    metadata = create_legacy_schema(engine)
+    started = time.perf_counter()
+    seed(engine, metadata, users, lobbies,
+         progress=lambda n, total: log(f"seeded {n}/{total} users", end='\r'))
+    log(f"\nseeded {users} users in {time.perf_counter() - started:.1f}s")
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(sa.text('ANALYZE'))
+    queries = hot_queries(users, lobbies)
+    before = measure(engine, queries, runs)
+    migration = upgrade(engine, log=log)
+    if engine.dialect.name == 'postgresql':
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(sa.text('ANALYZE'))
+    after = measure(engine, queries, runs)
+    return {'users': users, 'lobbies': lobbies, 'dialect': engine.dialect.name,
+            'migration_seconds': {k: round(v, 2) for k, v in migration.items()},
+            'before': before, 'after': after}
+
+
+def print_bench(report):
+    print(f"\n{report['users']} users, {report['lobbies']} lobbies on {report['dialect']}")
+    for step, seconds in report['migration_seconds'].items():
+        print(f"  migration {step}: {seconds}s")
+    print(f"\n{'query':<36} {'p50 before':>11} {'p50 after':>10} {'p95 before':>11} {'p95 after':>10}")
+    for name, b in report['before'].items():
+        a = report['after'][name]
+        print(f"{name:<36} {b['p50_ms']:>11} {a['p50_ms']:>10} {b['p95_ms']:>11} {a['p95_ms']:>10}")
+    for name, b in report['before'].items():
+        print(f"\n{name}\n  before: {' | '.join(b['plan'])}\n  after:  {' | '.join(report['after'][name]['plan'])}")
+
+
+def database_url():
+    return os.environ.get('DATABASE_URL', 'postgresql://postgres:postgres@db:5432/gridgame')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help='print the schema version')
+    sub.add_parser('upgrade', help='run pending migrations')
+    fill = sub.add_parser('backfill', help='(re)copy position into pos_x/pos_y')
+    fill.add_argument('--batch', type=int, default=BACKFILL_BATCH)
+    sub.add_parser('contract', help='drop user.position after upgrading')
+    b = sub.add_parser('bench', help='measure hot queries before and after upgrading')
+    b.add_argument('--users', type=int, default=1000000)
+    b.add_argument('--lobbies', type=int, default=2000)
+    b.add_argument('--runs', type=int, default=50, help='executions per query')
+    b.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.command == 'bench':
+        url = os.environ.get('DATABASE_URL')
+        if url is None:
+            url = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+        log = (lambda *a, **k: print(*a, file=sys.stderr, **k)) if args.json else print
+        report = bench(url, args.users, args.lobbies, args.runs, log=log)
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print_bench(report)
+        return 0
+
+    engine = sa.create_engine(database_url())
+    if args.command == 'status':
+        print(f"schema version {current_version(engine)} of {HEAD}")
+        for number, name, _, _ in pending(engine):
+            print(f"  pending: {number} {name}")
+    elif args.command == 'upgrade':
+        upgrade(engine)
+        print(f"schema version {current_version(engine)}")
+    elif args.command == 'backfill':
+        rows = backfill_positions(engine, args.batch,
+                                  progress=lambda n, total: print(f"{n}/{total}", end='\r'))
+        print(f"\nbackfilled {rows} rows")
+    elif args.command == 'contract':
+        contract(engine)
+        print('dropped user.position')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""Read, replay and fast-forward match logs written by the game server.
+
+Each lobby writes one file per match into ``REPLAY_DIR`` (see MATCH REPLAY
+in app.py). This tool streams such a file record by record, so memory use
+does not grow with the length of the match, and rebuilds the lobby state
+as it goes. It can:
+
+- print every record (``--events``), optionally paced at real time or at a
+  multiple of it (``--speed``);
+- jump to a tick (``--seek``) by skipping record bodies to the last
+  snapshot before it and replaying only from there;
+- print the final scoreboard and how much faster than real time the match
+  was replayed.
+
+Examples:
+
+    python replay.py replays/lobby3-20261016T120000-1.replay
+    python replay.py match.replay --seek 4000 --events
+    python replay.py match.replay --events --speed 4
+    python replay.py match.replay --json
+"""
+import sys
+import json
+import time
+import struct
+import argparse
+from collections import Counter
+
+# file layout; must match MATCH REPLAY in app.py
+REPLAY_MAGIC, REPLAY_VERSION = b'OATR', 1
+REPLAY_HEADER = struct.Struct('<4sBIIfHHd')
+RECORD_HEADER = struct.Struct('<IBI')
+(REC_SNAPSHOT, REC_JOIN, REC_LEAVE, REC_MOVE, REC_ATTACK,
+ REC_HIT, REC_STATE, REC_END) = range(1, 9)
+RECORD_NAMES = {REC_SNAPSHOT: 'snapshot', REC_JOIN: 'join', REC_LEAVE: 'leave',
+                REC_MOVE: 'move', REC_ATTACK: 'attack', REC_HIT: 'hit',
+                REC_STATE: 'state', REC_END: 'end'}
+REPLAY_PLAYER = struct.Struct('<IhhhIIHII')
+REPLAY_MOVE = struct.Struct('<Ihh')
+REPLAY_ATTACK = struct.Struct('<Ibb')
+REPLAY_HIT = struct.Struct('<IIhB')
+REPLAY_ID = struct.Struct('<I')
+REPLAY_COUNT = struct.Struct('<H')
+PLAYER_FIELDS = ('id', 'x', 'y', 'health', 'score', 'lifetime_score',
+                 'kills', 'deaths', 'wins')
+
+
+class ReplayError(Exception):
+    """The file is not a match log, or it is truncated mid-header."""
+
+
+def unpack_player(body, offset, named):
+    player = dict(zip(PLAYER_FIELDS, REPLAY_PLAYER.unpack_from(body, offset)))
+    offset += REPLAY_PLAYER.size
+    if named:
+        length = body[offset]
+        player['username'] = body[offset + 1:offset + 1 + length].decode(errors='replace')
+        offset += 1 + length
+    return player, offset
+
+
+def unpack_players(body, named):
+    count, = REPLAY_COUNT.unpack_from(body)
+    offset, players = REPLAY_COUNT.size, []
+    for _ in range(count):
+        player, offset = unpack_player(body, offset, named)
+        players.append(player)
+    return players
+
+
+def decode(kind, body):
+    """Turn a record body into a dict."""
+    if kind == REC_SNAPSHOT:
+        return {'players': unpack_players(body, named=True)}
+    if kind == REC_STATE:
+        return {'players': unpack_players(body, named=False)}
+    if kind == REC_JOIN:
+        return {'player': unpack_player(body, 0, named=True)[0]}
+    if kind == REC_LEAVE:
+        return {'id': REPLAY_ID.unpack(body)[0]}
+    if kind == REC_END:
+        return {'winner': REPLAY_ID.unpack(body)[0]}
+    if kind == REC_MOVE:
+        pid, x, y = REPLAY_MOVE.unpack(body)
+        return {'id': pid, 'x': x, 'y': y}
+    if kind == REC_ATTACK:
+        pid, dx, dy = REPLAY_ATTACK.unpack(body)
+        return {'id': pid, 'type': 'ranged' if dx or dy else 'melee', 'dx': dx, 'dy': dy}
+    if kind == REC_HIT:
+        attacker, target, damage, flags = REPLAY_HIT.unpack(body)
+        return {'attacker': attacker, 'target': target, 'damage': damage,
+                'killed': bool(flags & 1), 'won': bool(flags & 2)}
+    return {'raw': body.hex()}
+
+
+class ReplayReader:
+    """Streams the records of one match log.
+
+    Records are read one at a time through a buffered file, and
+    ``seek`` only reads record headers on its way to the snapshot it
+    needs. A record cut short by a crash ends the stream quietly.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        raw = self.file.read(REPLAY_HEADER.size)
+        if len(raw) < REPLAY_HEADER.size:
+            raise ReplayError(f"{path}: too short for a replay header")
+        magic, version, lobby_id, match, tick_rate, width, height, started = \
+            REPLAY_HEADER.unpack(raw)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ReplayError(f"{path}: not a version {REPLAY_VERSION} match log")
+        self.header = {'lobby_id': lobby_id, 'match': match, 'tick_rate': tick_rate,
+                       'grid': {'width': width, 'height': height}, 'started': started}
+        self.start = self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_header(self):
+        raw = self.file.read(RECORD_HEADER.size)
+        if len(raw) < RECORD_HEADER.size:
+            return None
+        return RECORD_HEADER.unpack(raw)
+
+    def records(self):
+        """Yield ``(kind, tick, body)`` from the current position to the end."""
+        while True:
+            header = self._next_header()
+            if header is None:
+                return
+            length, kind, tick = header
+            body = self.file.read(length)
+            if len(body) < length:
+                return
+            yield kind, tick, body
+
+    def seek(self, tick):
+        """Move to the last snapshot at or before ``tick``; returns its tick.
+
+        Falls back to the start of the file when no snapshot qualifies.
+        """
+        self.file.seek(self.start)
+        best, best_tick = self.start, None
+        while True:
+            offset = self.file.tell()
+            header = self._next_header()
+            if header is None:
+                break
+            length, kind, record_tick = header
+            if record_tick > tick:
+                break
+            if kind == REC_SNAPSHOT:
+                best, best_tick = offset, record_tick
+            self.file.seek(length, 1)
+        self.file.seek(best)
+        return best_tick
+
+
+class MatchState:
+    """Lobby state rebuilt by applying records in order."""
+
+    def __init__(self):
+        self.tick = 0
+        self.players = {}
+        self.winner = None
+        self.counts = Counter()
+
+    def apply(self, kind, tick, data):
+        self.tick = tick
+        self.counts[RECORD_NAMES.get(kind, 'unknown')] += 1
+        if kind == REC_SNAPSHOT:
+            self.players = {p['id']: p for p in data['players']}
+        elif kind == REC_JOIN:
+            self.players[data['player']['id']] = data['player']
+        elif kind == REC_LEAVE:
+            self.players.pop(data['id'], None)
+        elif kind == REC_STATE:
+            for p in data['players']:
+                known = self.players.setdefault(p['id'], {})
+                known.update(p)
+        elif kind == REC_END:
+            self.winner = data['winner']
+
+    def scoreboard(self):
+        return sorted(self.players.values(),
+                      key=lambda p: (-p['kills'], -p['score'], p['id']))
+
+
+def replay(path, seek=None, speed=0.0, on_record=None):
+    """Replay a match log; returns ``(header, state, report)``.
+
+    ``speed`` paces the replay at that multiple of real time (0 means as
+    fast as possible). ``on_record(kind, tick, data)`` is called for each
+    record applied.
+    """
+    state = MatchState()
+    with ReplayReader(path) as reader:
+        header = reader.header
+        start_tick = reader.seek(seek) if seek is not None else None
+        started = time.perf_counter()
+        first_tick = None
+        for kind, tick, body in reader.records():
+            data = decode(kind, body)
+            if first_tick is None and (seek is None or tick >= seek):
+                first_tick = tick
+            if speed > 0 and first_tick is not None:
+                due = (tick - first_tick) / header['tick_rate'] / speed
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            state.apply(kind, tick, data)
+            if on_record is not None and (seek is None or tick >= seek):
+                on_record(kind, tick, data)
+        elapsed = time.perf_counter() - started
+    ticks = state.tick - (first_tick or 0)
+    match_seconds = ticks / header['tick_rate'] if header['tick_rate'] else 0.0
+    report = {
+        'seeked_to': start_tick,
+        'ticks': ticks,
+        'match_seconds': round(match_seconds, 3),
+        'replay_seconds': round(elapsed, 4),
+        'speedup': round(match_seconds / elapsed, 1) if elapsed > 0 else None,
+        'records': dict(state.counts),
+    }
+    return header, state, report
+
+
+def print_report(header, state, report):
+    print(f"lobby {header['lobby_id']} match {header['match']} "
+          f"({header['grid']['width']}x{header['grid']['height']}, "
+          f"{header['tick_rate']:g} ticks/s)")
+    print(f"replayed {report['ticks']} ticks ({report['match_seconds']}s of play) "
+          f"in {report['replay_seconds']}s, {report['speedup']}x real time")
+    print('records: ' + ', '.join(f"{k}={v}" for k, v in report['records'].items()))
+    if state.winner is not None:
+        winner = state.players.get(state.winner, {}).get('username', state.winner)
+        print(f"winner: {winner}")
+    print(f"{'player':<20} {'kills':>5} {'deaths':>6} {'score':>6} {'health':>6}")
+    for p in state.scoreboard():
+        print(f"{p.get('username', p['id'])!s:<20} {p['kills']:>5} {p['deaths']:>6} "
+              f"{p['score']:>6} {p['health']:>6}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='match log written by the server')
+    parser.add_argument('--seek', type=int, help='start from this tick')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='pace at this multiple of real time (default: as fast as possible)')
+    parser.add_argument('--events', action='store_true', help='print every record')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    def print_record(kind, tick, data):
+        print(json.dumps({'tick': tick, 'record': RECORD_NAMES.get(kind, kind), **data}))
+
+    try:
+        header, state, report = replay(args.path, seek=args.seek, speed=args.speed,
+                                       on_record=print_record if args.events else None)
+    except (OSError, ReplayError) as e:
+        print(f"replay: {e}", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps({'header': header, 'report': report,
+                          'winner': state.winner, 'players': state.scoreboard()}))
+    else:
+        print_report(header, state, report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Register/login round-trip against a server started in production mode.
+
+Production mode serves on eventlet with the standard library monkey
+patched, which is where password hashing has to cooperate with the hub.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+requests = pytest.importorskip('requests')
+pytest.importorskip('eventlet')
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def production_server(tmp_path):
+    port = free_port()
+    env = dict(os.environ,
+               SERVER_MODE='production',
+               DATABASE_URL=f"sqlite:///{tmp_path / 'auth.db'}",
+               PORT=str(port),
+               # cheap hashes keep the test quick; the code path is the same
+               PASSWORD_HASH_METHOD='scrypt:1024:8:1')
+    # uploads/ and logs/ are created in the working directory
+    proc = subprocess.Popen([sys.executable, APP], cwd=tmp_path, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            # 503 while the startup phases are still running
+            if requests.get(url, timeout=1).status_code != 503:
+                break
+        except requests.RequestException:
+            pass
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            pytest.fail('production server did not start')
+        time.sleep(0.2)
+    yield url
+    proc.terminate()
+    proc.wait(timeout=10)
+
+
+def test_register_and_login(production_server):
+    creds = {'username': 'prod-user', 'password': 'correct horse'}
+    r = requests.post(f'{production_server}/register', json=creds, timeout=10)
+    assert r.status_code == 201, r.text
+    r = requests.post(f'{production_server}/login', json=creds, timeout=10)
+    assert r.status_code == 200, r.text
+    r = requests.post(f'{production_server}/login', timeout=10,
+                      json={**creds, 'password': 'wrong'})
+    assert r.status_code == 401, r.text